@@ -0,0 +1,271 @@
+// Clientside filtering, sorting and paging of the critical-values table.
+// The critical values of the selected zone / rate columns are shipped once in the 'critical-store'
+// (see load_critical_table); product / crop / region selections and the DataTable's own filter,
+// sort and paging are then applied here without a server round trip. Tables too large for the
+// browser come back as {mode: 'server'} with the page of the table state they were computed
+// for; later table states are forwarded to display_data.
+(function () {
+    var FILTER_OPERATORS = [['ge ', '>='],
+                            ['le ', '<='],
+                            ['lt ', '<'],
+                            ['gt ', '>'],
+                            ['ne ', '!='],
+                            ['eq ', '='],
+                            ['contains '],
+                            ['datestartswith ']];
+
+    function isUnfiltered(selection) {
+        // The dropdowns send null before first use, [] when cleared and ['All'] for the "All" option
+        return selection === null || selection === undefined || selection.length === 0 ||
+            (selection.length === 1 && selection[0] === 'All');
+    }
+
+    function asText(value) {
+        return value === null || value === undefined ? 'None' : String(value);
+    }
+
+    function asNumber(value) {
+        if (value === null || value === undefined || value === '' || typeof value === 'boolean') {
+            return NaN;
+        }
+        return Number(value);
+    }
+
+    // Same parsing as cgap_filter.split_filter_part
+    function splitFilterPart(filterPart) {
+        for (var i = 0; i < FILTER_OPERATORS.length; i++) {
+            var operatorType = FILTER_OPERATORS[i];
+            for (var j = 0; j < operatorType.length; j++) {
+                var at = filterPart.indexOf(operatorType[j]);
+                if (at < 0) {
+                    continue;
+                }
+                var namePart = filterPart.slice(0, at);
+                var valuePart = filterPart.slice(at + operatorType[j].length).trim();
+                var name = namePart.slice(namePart.indexOf('{') + 1, namePart.lastIndexOf('}'));
+                var quote = valuePart.charAt(0);
+                var value;
+                if (quote && quote === valuePart.charAt(valuePart.length - 1) && "'\"`".indexOf(quote) >= 0) {
+                    value = valuePart.slice(1, -1).split('\\' + quote).join(quote);
+                } else if (valuePart !== '' && !isNaN(Number(valuePart))) {
+                    value = Number(valuePart);
+                } else {
+                    value = valuePart;
+                }
+                return [name, operatorType[0].trim(), value];
+            }
+        }
+        return [null, null, null];
+    }
+
+    function compare(operator, cell, value) {
+        switch (operator) {
+        case 'eq': return cell === value;
+        case 'ne': return cell !== value;
+        case 'lt': return cell < value;
+        case 'le': return cell <= value;
+        case 'gt': return cell > value;
+        case 'ge': return cell >= value;
+        }
+        return true;
+    }
+
+    // Same semantics as cgap_filter.apply_filter_query
+    function applyFilterQuery(rows, columns, filterQuery) {
+        if (!filterQuery) {
+            return rows;
+        }
+        filterQuery.split(' && ').forEach(function (filterPart) {
+            var parsed = splitFilterPart(filterPart);
+            var col = parsed[0], operator = parsed[1], value = parsed[2];
+            if (columns.indexOf(col) < 0) {
+                return;
+            }
+            rows = rows.filter(function (row) {
+                var cell = row[col];
+                if (['eq', 'ne', 'lt', 'le', 'gt', 'ge'].indexOf(operator) >= 0) {
+                    if (typeof value === 'number') {
+                        // GAP columns mix numbers with text such as '-': compare the numeric part only
+                        var number = asNumber(cell);
+                        return isNaN(number) ? operator === 'ne' : compare(operator, number, value);
+                    }
+                    return compare(operator, asText(cell), String(value));
+                }
+                if (operator === 'contains') {
+                    return asText(cell).toLowerCase().indexOf(String(value).toLowerCase()) >= 0;
+                }
+                if (operator === 'datestartswith') {
+                    return asText(cell).indexOf(String(value)) === 0;
+                }
+                return true;
+            });
+        });
+        return rows;
+    }
+
+    // Returns [order, pinned]: missing values, and text next to numbers, sort last in both
+    // directions (pinned); otherwise numbers (and numeric text) compare numerically, text alphabetically
+    function compareCells(a, b) {
+        var aMissing = a === null || a === undefined, bMissing = b === null || b === undefined;
+        if (aMissing || bMissing) {
+            return [aMissing === bMissing ? 0 : (aMissing ? 1 : -1), true];
+        }
+        var aNumber = asNumber(a), bNumber = asNumber(b);
+        if (!isNaN(aNumber) && !isNaN(bNumber)) {
+            return [aNumber - bNumber, false];
+        }
+        if (isNaN(aNumber) !== isNaN(bNumber)) {
+            return [isNaN(aNumber) ? 1 : -1, true];
+        }
+        return [String(a) < String(b) ? -1 : (String(a) > String(b) ? 1 : 0), false];
+    }
+
+    function applySort(rows, columns, sortBy) {
+        var keys = (sortBy || []).filter(function (sort) { return columns.indexOf(sort.column_id) >= 0; });
+        if (!keys.length) {
+            return rows;
+        }
+        // Array.prototype.sort is stable, like the server's mergesort
+        return rows.slice().sort(function (a, b) {
+            for (var i = 0; i < keys.length; i++) {
+                var compared = compareCells(a[keys[i].column_id], b[keys[i].column_id]);
+                if (compared[0] !== 0) {
+                    return keys[i].direction === 'asc' || compared[1] ? compared[0] : -compared[0];
+                }
+            }
+            return 0;
+        });
+    }
+
+    function selectRows(rows, col, selection) {
+        if (isUnfiltered(selection)) {
+            return rows;
+        }
+        var wanted = {};
+        selection.forEach(function (value) { wanted[asText(value)] = true; });
+        return rows.filter(function (row) { return wanted[asText(row[col])] === true; });
+    }
+
+    // Decode a cgap_wire.encode_frame payload: per column a dictionary of distinct values and
+    // base64-packed little-endian codes into it (0 is null)
+    function decodeCodes(packed, type) {
+        var binary = atob(packed);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        if (type === 'u1') {
+            return bytes;
+        }
+        return type === 'u2' ? new Uint16Array(bytes.buffer) : new Uint32Array(bytes.buffer);
+    }
+
+    function decodeFrame(payload) {
+        var rows = new Array(payload.length);
+        for (var i = 0; i < payload.length; i++) {
+            rows[i] = {};
+        }
+        payload.columns.forEach(function (col, j) {
+            var codes = decodeCodes(payload.codes[j], payload.types[j]);
+            var dictionary = payload.dictionaries[j];
+            for (var i = 0; i < payload.length; i++) {
+                rows[i][col] = dictionary[codes[i]];
+            }
+        });
+        return rows;
+    }
+
+    function tableColumns(payload) {
+        return payload.columns.map(function (col) { return {name: col, id: col}; });
+    }
+
+    // The critical-store is decoded once per table, not on every filter change
+    var decodedStore = {table: null, rows: null};
+
+    function storeRows(store) {
+        if (decodedStore.table !== store.table) {
+            decodedStore = {table: store.table, rows: decodeFrame(store.table)};
+        }
+        return decodedStore.rows;
+    }
+
+    var noUpdate = function () { return window.dash_clientside.no_update; };
+
+    // Server mode: the table state a page is asked for (see server_page)
+    var QUERY_FIELDS = ['key', 'product', 'crop', 'region', 'page_current', 'page_size', 'sort_by', 'filter_query'];
+
+    function tableQuery(store, product, crop, region, pageCurrent, pageSize, sortBy, filterQuery) {
+        return {
+            key: store.key, zone_column: store.zone_column, rate_column: store.rate_column,
+            product: product, crop: crop, region: region,
+            page_current: pageCurrent, page_size: pageSize,
+            sort_by: sortBy, filter_query: filterQuery
+        };
+    }
+
+    function sameQuery(a, b) {
+        if (!a || !b) {
+            return false;
+        }
+        return QUERY_FIELDS.every(function (field) {
+            var aValue = a[field] === undefined ? null : a[field];
+            var bValue = b[field] === undefined ? null : b[field];
+            return JSON.stringify(aValue) === JSON.stringify(bValue);
+        });
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        cgap: {
+            loadingStyle: function (loadingState) {
+                // Blur the table area while it loads
+                var blur = loadingState && loadingState.is_loading ? 'blur(2px)' : 'blur(0px)';
+                return {filter: blur, transition: 'filter 0.3s ease'};
+            },
+
+            forwardQuery: function (product, crop, region, pageCurrent, pageSize, sortBy, filterQuery, store) {
+                // Client mode: nothing to ask the server
+                if (!store || store.mode !== 'server') {
+                    return noUpdate();
+                }
+                var query = tableQuery(store, product, crop, region, pageCurrent, pageSize, sortBy, filterQuery);
+                // The page of this state came with the store
+                return sameQuery(query, store.page && store.page.query) ? noUpdate() : query;
+            },
+
+            renderTable: function (product, crop, region, pageCurrent, pageSize, sortBy, filterQuery,
+                                   store, serverPage) {
+                if (!store) {
+                    return [[], [], 1];
+                }
+                if (store.mode === 'server') {
+                    // Show the page computed for the current table state, from the store or display_data;
+                    // wait while it is on its way
+                    var query = tableQuery(store, product, crop, region, pageCurrent, pageSize, sortBy, filterQuery);
+                    var page = [serverPage, store.page].filter(function (candidate) {
+                        return candidate && sameQuery(query, candidate.query);
+                    })[0];
+                    if (!page) {
+                        return [noUpdate(), noUpdate(), noUpdate()];
+                    }
+                    return [decodeFrame(page.table), tableColumns(page.table), page.page_count];
+                }
+
+                var columns = store.table.columns;
+                var rows = storeRows(store);
+                rows = selectRows(rows, 'Product(PLT short)', product);
+                rows = selectRows(rows, 'Crop', crop);
+                rows = selectRows(rows, store.zone_column, region);
+                rows = applySort(applyFilterQuery(rows, columns, filterQuery), columns, sortBy);
+
+                pageSize = pageSize || 100;
+                var pageCount = Math.max(1, Math.ceil(rows.length / pageSize));
+                pageCurrent = Math.min(pageCurrent || 0, pageCount - 1);
+                return [
+                    rows.slice(pageCurrent * pageSize, (pageCurrent + 1) * pageSize),
+                    tableColumns(store.table),
+                    pageCount
+                ];
+            }
+        }
+    });
+})();
@@ -0,0 +1,175 @@
+# Critical-GAP aggregation, memoized per (dataset, zone column, rate column).
+# Product / crop / region filter changes only subset a cached result instead of re-running the groupby.
+# Results are also written to the on-disk cache next to their dataset, so the other worker
+# processes map the same file instead of each computing and holding their own copy.
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import cgap_cache
+import cgap_metrics
+import cgap_versions
+from cgap_filter import FilterIndex
+from cgap_pipeline import rate_columns_of, region_columns_of
+
+
+GROUP_COLUMNS = ['Product(PLT short)', 'Crop', 'Max # of applns.(per block)']
+# Tie-breaks after the application rate, in order: (column, smaller is more critical)
+RANKING = [('Application timing BBCH end', False),
+           ('PHI', True),
+           ('Minimum appl. interval(days)', True)]
+TOTAL_LOAD_COLUMN = 'Rate x applications (g/ha)'
+MEMO_SIZE = int(os.environ.get('CGAP_AGGREGATE_MEMO_SIZE', '64'))
+WARM_ON_UPLOAD = os.environ.get('CGAP_WARM_AGGREGATES', '1') != '0'
+
+_memo = OrderedDict()
+_lock = threading.Lock()
+# One lock per key being computed, so the warm-up thread and a request never rank the same columns twice
+_computing = {}
+
+
+def compute_critical_values(cgap_df, zone_column, rate_column):
+    with cgap_metrics.span('groupby') as span:
+        critical_values = _rank_critical_values(cgap_df, zone_column, rate_column)
+        span['rows'] = len(critical_values)
+    return critical_values
+
+
+def _rank_critical_values(cgap_df, zone_column, rate_column):
+    """Pick the most critical source row of every group with one multi-key sort.
+
+    Rows are ranked by the README criteria: highest rate, latest BBCH, shortest PHI,
+    smallest interval, then highest rate x number of applications; missing or
+    non-numeric values ('-') rank last.
+    """
+    keys = [zone_column] + GROUP_COLUMNS
+    rate = pd.to_numeric(cgap_df[rate_column], errors='coerce')
+    total_load = rate * pd.to_numeric(cgap_df['Max # of applns.(per block)'], errors='coerce')
+    # Every key sorts ascending with NaN last: the "higher is more critical" ones are negated
+    sort_keys = [-rate.to_numpy(float)]
+    for col, ascending in RANKING:
+        values = pd.to_numeric(cgap_df[col], errors='coerce').to_numpy(float)
+        sort_keys.append(values if ascending else -values)
+    sort_keys.append(-total_load.to_numpy(float))
+
+    groups = cgap_df.groupby(keys, observed=True, sort=True).ngroup().fillna(-1).to_numpy(np.int64)
+    # np.lexsort sorts on the last key first
+    order = np.lexsort(sort_keys[::-1] + [groups])
+    order = order[groups[order] >= 0]
+    sorted_groups = groups[order]
+    winners = order[np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]] if len(order) else order
+
+    critical_values = cgap_df.iloc[winners][keys + [rate_column] + [col for col, _ in RANKING]].reset_index(drop=True)
+    critical_values[TOTAL_LOAD_COLUMN] = total_load.to_numpy()[winners]
+    return critical_values
+
+
+def _entry(dataset_token, cgap_df, zone_column, rate_column):
+    key = (dataset_token, zone_column, rate_column)
+    with _lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+        key_lock = _computing.setdefault(key, threading.Lock())
+    with key_lock:
+        try:
+            with _lock:
+                # Computed by the thread this one waited for
+                if key in _memo:
+                    _memo.move_to_end(key)
+                    return _memo[key]
+            shared_key = cgap_cache.derived_key(dataset_token, zone_column, rate_column)
+            frame = cgap_cache.get(shared_key)
+            if frame is None:
+                frame = compute_critical_values(cgap_df, zone_column, rate_column)
+                cgap_cache.put(shared_key, frame)
+            return _store(key, frame)
+        finally:
+            with _lock:
+                if _computing.get(key) is key_lock:
+                    del _computing[key]
+
+
+def _store(key, frame):
+    entry = {'frame': frame, 'index': None}
+    with _lock:
+        entry = _memo.setdefault(key, entry)
+        _memo.move_to_end(key)
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return entry
+
+
+def critical_values(dataset_token, cgap_df, zone_column, rate_column):
+    """Return the critical values of cgap_df for the chosen columns, computing them at most once."""
+    return _entry(dataset_token, cgap_df, zone_column, rate_column)['frame']
+
+
+def filter_index(dataset_token, cgap_df, zone_column, rate_column):
+    """Return the FilterIndex over the product, crop and zone columns of the critical values."""
+    entry = _entry(dataset_token, cgap_df, zone_column, rate_column)
+    if entry['index'] is None:
+        with cgap_metrics.span('filter index build'):
+            entry['index'] = FilterIndex(entry['frame'], ['Product(PLT short)', 'Crop', zone_column])
+    return entry['index']
+
+
+def carry_over(previous_token, previous_df, dataset_token, cgap_df):
+    """Seed the memo of a revised dataset from the critical values of its previous version.
+
+    Only the groups whose rows changed between the versions are ranked again. Returns the
+    change report of every carried-over zone column x rate column combination, or None when
+    cgap_df is not a revision of previous_df.
+    """
+    with _lock:
+        previous = [(key[1], key[2], entry['frame']) for key, entry in _memo.items() if key[0] == previous_token]
+    if not previous:
+        return None
+    with cgap_metrics.span('version diff') as span:
+        removed, added = cgap_versions.diff_rows(previous_df, cgap_df)
+        span['rows'] = len(removed) + len(added)
+    if not cgap_versions.is_revision(previous_df, cgap_df, removed, added):
+        return None
+
+    reports = []
+    # The affected groups and their rows only depend on the zone column
+    affected = {}
+    for zone_column, rate_column, previous_critical in previous:
+        keys = [zone_column] + GROUP_COLUMNS
+        with cgap_metrics.span('incremental recompute') as span:
+            if zone_column not in affected:
+                groups = cgap_versions.affected_groups(previous_df, removed, cgap_df, added, keys)
+                affected[zone_column] = groups, cgap_df[cgap_versions.in_groups(cgap_df, keys, groups)]
+            groups, rows = affected[zone_column]
+            recomputed = compute_critical_values(rows, zone_column, rate_column)
+            critical_values = cgap_versions.merge_critical_values(previous_critical, recomputed, groups, keys, cgap_df)
+            span['rows'] = len(rows)
+        cgap_cache.put(cgap_cache.derived_key(dataset_token, zone_column, rate_column), critical_values)
+        _store((dataset_token, zone_column, rate_column), critical_values)
+        report = cgap_versions.change_report(previous_critical, critical_values, groups, keys, rate_column)
+        report = report.rename(columns={zone_column: 'Zone',
+                                        rate_column + ' (previous)': 'Application rate (g/ha) (previous)',
+                                        rate_column: 'Application rate (g/ha)'})
+        report.insert(0, 'Zone column', zone_column)
+        report.insert(1, 'Rate column', rate_column)
+        reports.append(report)
+    return pd.concat(reports, ignore_index=True)
+
+
+def warm(dataset_token, cgap_df):
+    """Precompute every zone column x rate column combination of a freshly uploaded dataset."""
+    for zone_column in region_columns_of(cgap_df):
+        for rate_column in rate_columns_of(cgap_df):
+            try:
+                filter_index(dataset_token, cgap_df, zone_column, rate_column)
+            except Exception:
+                # Leave it to the interactive request to surface the error
+                cgap_metrics.logger.warning('cannot precompute %s x %s', zone_column, rate_column, exc_info=True)
+
+
+def warm_in_background(dataset_token, cgap_df):
+    if WARM_ON_UPLOAD:
+        threading.Thread(target=warm, args=(dataset_token, cgap_df), daemon=True).start()
@@ -13,95 +13,106 @@ from dash.exceptions import PreventUpdate
 
 import openpyxl 
 
+from cgap_store import SessionStore, new_session_id
+
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
-# Define the layout of the app
-app.layout = dbc.Container(
-    fluid=True,
-    style={'backgroundColor': '#48A0E8'},
-    children=[
-        dbc.Row(
-            dbc.Col(html.H1('cGAP APP', className='text-center mb-4'), width=10)
-        ),
-        dbc.Row(
-            dbc.Col(
-                dbc.Card(
-                    dbc.CardBody([
-                        dcc.Markdown('''
-                          This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory managers,
-                                      in which there are each of the requested GAPs by country, crop and product. 
+# Define the layout of the app; it is served by a function so every page load gets its own session id
+def serve_layout():
+    return dbc.Container(
+        fluid=True,
+        style={'backgroundColor': '#48A0E8'},
+        children=[
+            dbc.Row(
+                dbc.Col(html.H1('cGAP APP', className='text-center mb-4'), width=10)
+            ),
+            dbc.Row(
+                dbc.Col(
+                    dbc.Card(
+                        dbc.CardBody([
+                            dcc.Markdown('''
+                              This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory managers,
+                                          in which there are each of the requested GAPs by country, crop and product. 
                                      
-                            This app identifies among all these GAPs, the most critical GAP 
-                                     by formulation (J-neck) / by regulatory zone (G-collar) / by crop (O-collar). 
+                                This app identifies among all these GAPs, the most critical GAP 
+                                         by formulation (J-neck) / by regulatory zone (G-collar) / by crop (O-collar). 
                                      
-                             As for crops, for cereals, we disgard rye, triticale, spelt, oat , and we group together the some crops (eg Barley: spring & winter) and  (eg wheat : durum, spring, winter).
-                                      The crop groups include 'Barley' , 'Wheat', 'Cabbage' , 'Onion' and 'Rape'.
+                                 As for crops, for cereals, we disgard rye, triticale, spelt, oat , and we group together the some crops (eg Barley: spring & winter) and  (eg wheat : durum, spring, winter).
+                                          The crop groups include 'Barley' , 'Wheat', 'Cabbage' , 'Onion' and 'Rape'.
                                      
-                            Here are the 5 criteria used to define the most critical GAP:
+                                Here are the 5 criteria used to define the most critical GAP:
                                      
-                                        - 1 - Application rate PTZ (g/ha), higher is the most critical
-                                        - 2 - Nb of application , the highest is the most critical #(the g/ha for multiple Nb of app in not yet evaluated)
-                                        - 3 - BBCH stage the latest, max is the most critical
-                                        - 4 - The shortest PHI (PHI): smaller  is the most critical
-                                        - 5 - Interval between applications, the smallest interval is the most critical     
-                                                                ''') ,
-                    ]),
-                    className="mb-3",
-                    style={'backgroundColor': '#61ADEB'} 
-                ),
-                #width={'size': 8, 'offset': 3}  # Center the card on the page
-            )
-        ),
-
-
-        dbc.Row(
-            dbc.Col(
-                dcc.Upload(
-                    id='upload-data',
-                    children=html.Div([
-                        'Drag and Drop or ',
-                        html.A('Select Files')
-                    ]),
-                    style={
-                        'width': '100%',
-                        'height': '60px',
-                        'lineHeight': '60px',
-                        'borderWidth': '1px',
-                        'borderStyle': 'dashed',
-                        'borderRadius': '5px',
-                        'textAlign': 'center'
-                    },
-                    multiple=False
-                ),
-                width=12
-            )
-        ),
-        dbc.Row(
-            dbc.Col(
-                html.Div(id='filtered-table', style={'marginTop': '30px'}),
-                #width={'size': 8, 'offset': 3}
-            )
-        ),
-         # Add the download button and link container
-        html.Div([
-            dbc.Button('Download Data', id='download-button', color='primary', className='mt-3'),
-            dcc.Download(id='download-dataframe-csv'),
-            html.Div(id='download-link-container')
-        ])
-
+                                            - 1 - Application rate PTZ (g/ha), higher is the most critical
+                                            - 2 - Nb of application , the highest is the most critical #(the g/ha for multiple Nb of app in not yet evaluated)
+                                            - 3 - BBCH stage the latest, max is the most critical
+                                            - 4 - The shortest PHI (PHI): smaller  is the most critical
+                                            - 5 - Interval between applications, the smallest interval is the most critical     
+                                                                    ''') ,
+                        ]),
+                        className="mb-3",
+                        style={'backgroundColor': '#61ADEB'} 
+                    ),
+                    #width={'size': 8, 'offset': 3}  # Center the card on the page
+                )
+            ),
+
+
+            dbc.Row(
+                dbc.Col(
+                    dcc.Upload(
+                        id='upload-data',
+                        children=html.Div([
+                            'Drag and Drop or ',
+                            html.A('Select Files')
+                        ]),
+                        style={
+                            'width': '100%',
+                            'height': '60px',
+                            'lineHeight': '60px',
+                            'borderWidth': '1px',
+                            'borderStyle': 'dashed',
+                            'borderRadius': '5px',
+                            'textAlign': 'center'
+                        },
+                        multiple=False
+                    ),
+                    width=12
+                )
+            ),
+            dbc.Row(
+                dbc.Col(
+                    html.Div(id='filtered-table', style={'marginTop': '30px'}),
+                    #width={'size': 8, 'offset': 3}
+                )
+            ),
+             # Add the download button and link container
+            html.Div([
+                dbc.Button('Download Data', id='download-button', color='primary', className='mt-3'),
+                dcc.Download(id='download-dataframe-csv'),
+                html.Div(id='download-link-container')
+            ]),
+            dcc.Store(id='session-id', data=new_session_id())
+
+
+        ]
+    )
+
+
+app.layout = serve_layout
+
+# Frames of each browser session (replaces the critical_values global)
+session_store = SessionStore()
 
-    ]
-)
 
 
 # Callback to handle the file upload and display the data
 @app.callback(
     Output('filtered-table', 'children'),
     [Input('upload-data', 'contents')],
-    [State('upload-data', 'filename')]
+    [State('upload-data', 'filename'),
+     State('session-id', 'data')]
 )
-def update_output(contents, filename):
-    global critical_values
+def update_output(contents, filename, session_id):
     if contents is not None:
         content_type, content_string = contents.split(',')
         decoded = base64.b64decode(content_string)
@@ -138,6 +149,7 @@ def update_output(contents, filename):
                                                                                         'applicationn timing BBCH end':'max',
                                                                                         'PHI':'min',
                                                                                         'Minimum appl. interval(days)':'min'}).reset_index()
+            session_store.put(session_id, 'critical_values', critical_values)
             #critical_values.columns = critical_values.columns.str.replace('[^\w\s]', '').str.replace(' ', '_')
 
 
@@ -182,15 +194,16 @@ def update_output(contents, filename):
 @app.callback(
     Output('download-link-container', 'children'),
     Input('download-button', 'n_clicks'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def generate_download_link(n_clicks):
-    global critical_values  # Access the global variable
-    if n_clicks is not None and n_clicks > 0:
+def generate_download_link(n_clicks, session_id):
+    critical_values = session_store.get(session_id, 'critical_values')
+    if n_clicks is not None and n_clicks > 0 and critical_values is not None:
         # Assume 'filtered_df' is the filtered dataframe you want to download
         csv_string = critical_values.to_csv(index=False, encoding='utf-8-sig')
         csv_string = "data:text/csv;charset=utf-8-sig," + urllib.parse.quote(csv_string)
         return html.A('Download Filtered CSV', href=csv_string, download="filtered_data.csv", target='_blank', style={'font-weight': 'bold', 'color': 'red'})
-    return no_update
+    return dash.no_update
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
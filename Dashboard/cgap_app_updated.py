@@ -13,114 +13,125 @@ from dash.exceptions import PreventUpdate
 
 import openpyxl 
 
+from cgap_store import SessionStore, new_session_id
+
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
-# Define the layout of the app
-app.layout = dbc.Container(
-    fluid=True,
-    style={'backgroundColor': '#48A0E8'},
-    children=[
-        dbc.Row(
-            dbc.Col(html.H1('cGAP APP', className='text-center mb-4'), width=10)
-        ),
-        dbc.Row(
-            dbc.Col(
-                dbc.Card(
-                    dbc.CardBody([
-                        dcc.Markdown('''
-                          This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory managers,
-                                      in which there are each of the requested GAPs by country, crop and product. 
+# Define the layout of the app; it is served by a function so every page load gets its own session id
+def serve_layout():
+    return dbc.Container(
+        fluid=True,
+        style={'backgroundColor': '#48A0E8'},
+        children=[
+            dbc.Row(
+                dbc.Col(html.H1('cGAP APP', className='text-center mb-4'), width=10)
+            ),
+            dbc.Row(
+                dbc.Col(
+                    dbc.Card(
+                        dbc.CardBody([
+                            dcc.Markdown('''
+                              This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory managers,
+                                          in which there are each of the requested GAPs by country, crop and product. 
                                      
-                            This app identifies among all these GAPs, the most critical GAP 
-                                     by formulation (J-neck) / by regulatory zone (G-collar) / by crop (O-collar). 
+                                This app identifies among all these GAPs, the most critical GAP 
+                                         by formulation (J-neck) / by regulatory zone (G-collar) / by crop (O-collar). 
                                      
-                             As for crops, for cereals, we disgard rye, triticale, spelt, oat , and we group together the some crops (eg Barley: spring & winter) and  (eg wheat : durum, spring, winter).
-                                      The crop groups include 'Barley' , 'Wheat', 'Cabbage' , 'Onion' and 'Rape'.
+                                 As for crops, for cereals, we disgard rye, triticale, spelt, oat , and we group together the some crops (eg Barley: spring & winter) and  (eg wheat : durum, spring, winter).
+                                          The crop groups include 'Barley' , 'Wheat', 'Cabbage' , 'Onion' and 'Rape'.
                                      
-                            Here are the 5 criteria used to define the most critical GAP:
+                                Here are the 5 criteria used to define the most critical GAP:
                                      
-                                        - 1 - Application rate PTZ (g/ha), higher is the most critical
-                                        - 2 - Nb of application , the highest is the most critical #(the g/ha for multiple Nb of app in not yet evaluated)
-                                        - 3 - BBCH stage the latest, max is the most critical
-                                        - 4 - The shortest PHI (PHI): smaller  is the most critical
-                                        - 5 - Interval between applications, the smallest interval is the most critical     
-                                                                ''') ,
-                    ]),
-                    className="mb-3",
-                    style={'backgroundColor': '#61ADEB'} 
-                ),
-                #width={'size': 8, 'offset': 3}  # Center the card on the page
-            )
-        ),
-
-
-        dbc.Row(
-            dbc.Col(
-                dcc.Upload(
-                    id='upload-data',
-                    children=html.Div([
-                        'Drag and Drop or ',
-                        html.A('Select Files')
-                    ]),
-                    style={
-                        'width': '100%',
-                        'height': '60px',
-                        'lineHeight': '60px',
-                        'borderWidth': '1px',
-                        'borderStyle': 'dashed',
-                        'borderRadius': '5px',
-                        'textAlign': 'center'
-                    },
-                    multiple=False
-                ),
-                width=12
-            )
-        ),
+                                            - 1 - Application rate PTZ (g/ha), higher is the most critical
+                                            - 2 - Nb of application , the highest is the most critical #(the g/ha for multiple Nb of app in not yet evaluated)
+                                            - 3 - BBCH stage the latest, max is the most critical
+                                            - 4 - The shortest PHI (PHI): smaller  is the most critical
+                                            - 5 - Interval between applications, the smallest interval is the most critical     
+                                                                    ''') ,
+                        ]),
+                        className="mb-3",
+                        style={'backgroundColor': '#61ADEB'} 
+                    ),
+                    #width={'size': 8, 'offset': 3}  # Center the card on the page
+                )
+            ),
+
+
+            dbc.Row(
+                dbc.Col(
+                    dcc.Upload(
+                        id='upload-data',
+                        children=html.Div([
+                            'Drag and Drop or ',
+                            html.A('Select Files')
+                        ]),
+                        style={
+                            'width': '100%',
+                            'height': '60px',
+                            'lineHeight': '60px',
+                            'borderWidth': '1px',
+                            'borderStyle': 'dashed',
+                            'borderRadius': '5px',
+                            'textAlign': 'center'
+                        },
+                        multiple=False
+                    ),
+                    width=12
+                )
+            ),
         
-        dcc.Dropdown(
-            id='product-filter',
-            options=[],
-            multi=True,
-            placeholder='Select Product'
-        ),
-        dcc.Dropdown(
-            id='crop-filter',
-            options=[],
-            multi=True,
-            placeholder='Select crop'
-        ),
-        dcc.Dropdown(
-            id='region-filter',
-            options=[],
-            multi=True,
-            placeholder='Select region'
-        ),
-        dbc.Row(
-            dbc.Col(
-                html.Div(id='filtered-table', style={'marginTop': '30px'}),
-                #width={'size': 8, 'offset': 3}
-            )
-        ),
-
-        dbc.Row(
-            dbc.Col(
-                html.Div(id='msg_table', style={'marginTop': '30px'}),
-                #width={'size': 8, 'offset': 3}
-            )
-        ),
+            dcc.Dropdown(
+                id='product-filter',
+                options=[],
+                multi=True,
+                placeholder='Select Product'
+            ),
+            dcc.Dropdown(
+                id='crop-filter',
+                options=[],
+                multi=True,
+                placeholder='Select crop'
+            ),
+            dcc.Dropdown(
+                id='region-filter',
+                options=[],
+                multi=True,
+                placeholder='Select region'
+            ),
+            dbc.Row(
+                dbc.Col(
+                    html.Div(id='filtered-table', style={'marginTop': '30px'}),
+                    #width={'size': 8, 'offset': 3}
+                )
+            ),
+
+            dbc.Row(
+                dbc.Col(
+                    html.Div(id='msg_table', style={'marginTop': '30px'}),
+                    #width={'size': 8, 'offset': 3}
+                )
+            ),
       
-         # Add the download button and link container
-        html.Div([
-            dbc.Button('Download Data', id='download-button', color='primary', className='mt-3'),
-            dcc.Download(id='download-dataframe-csv'),
-            html.Div(id='download-link-container')
-        ])
+             # Add the download button and link container
+            html.Div([
+                dbc.Button('Download Data', id='download-button', color='primary', className='mt-3'),
+                dcc.Download(id='download-dataframe-csv'),
+                html.Div(id='download-link-container')
+            ]),
+            dcc.Store(id='session-id', data=new_session_id())
+
+
+        ]
+    )
 
 
-    ]
-)
 
 
+app.layout = serve_layout
+
+# Frames of each browser session (replaces the critical_values global)
+session_store = SessionStore()
+
 
 
 # Callback to handle the file upload and display the data
@@ -130,12 +141,12 @@ app.layout = dbc.Container(
      Output('product-filter', 'options'),
      Output('region-filter', 'options')],
     [Input('upload-data', 'contents')],
-    [State('upload-data', 'filename')]
+    [State('upload-data', 'filename'),
+     State('session-id', 'data')]
 )
 
-def import_data(contents,filename):
+def import_data(contents,filename, session_id):
     print('---- am in function 1 ---- ')
-    global critical_values 
 
 
     if contents is not None:
@@ -181,6 +192,7 @@ def import_data(contents,filename):
                                                                                     'applicationn timing BBCH end':'max',
                                                                                     'PHI':'min',
                                                                                     'Minimum appl. interval(days)':'min'}).reset_index()
+        session_store.put(session_id, 'critical_values', critical_values)
         
         # Define the options for the dropdowns with the "All" option
         crop_options = [{'label': 'All', 'value': 'All'}] + [{'label': crop, 'value': crop} for crop in critical_values['Crop'].unique()]
@@ -212,16 +224,15 @@ def import_data(contents,filename):
     [Input('product-filter', 'value'),
      Input('crop-filter', 'value'),
      Input('region-filter', 'value')],
-    [State('upload-data', 'contents'),
-     State('upload-data', 'filename')]
+    [State('session-id', 'data')]
 )
 
 
-def display_data(product_options, crop_options, region_options, contents, filename):
-    global critical_values 
+def display_data(product_options, crop_options, region_options, session_id):
+    critical_values = session_store.get(session_id, 'critical_values')
     print('----- function 2 triggered-------')
 
-    if contents is not None:
+    if critical_values is not None:
         print('----- function 2 begin-------')
         # Process the uploaded file and extract options for product and application filters
         
@@ -295,16 +306,17 @@ def display_data(product_options, crop_options, region_options, contents, filena
 @app.callback(
     Output('download-link-container', 'children'),
     Input('download-button', 'n_clicks'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def generate_download_link(n_clicks):
-    global critical_values  # Access the global variable
-    if n_clicks is not None and n_clicks > 0:
+def generate_download_link(n_clicks, session_id):
+    critical_values = session_store.get(session_id, 'critical_values')
+    if n_clicks is not None and n_clicks > 0 and critical_values is not None:
         # Assume 'filtered_df' is the filtered dataframe you want to download
         csv_string = critical_values.to_csv(index=False, encoding='utf-8-sig')
         csv_string = "data:text/csv;charset=utf-8-sig," + urllib.parse.quote(csv_string)
         return html.A('Download Filtered CSV', href=csv_string, download="filtered_data.csv", target='_blank', style={'font-weight': 'bold', 'color': 'red'})
-    return no_update
+    return dash.no_update
 
 
 
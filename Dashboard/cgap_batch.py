@@ -0,0 +1,155 @@
+# Headless batch mode: compute the critical GAPs of every Master GAP workbook in a directory.
+#
+#   python Dashboard/cgap_batch.py "path/to/workbooks" -o "path/to/output" --workers 4
+#
+# Writes one output per workbook plus a combined output, and reports per-file timings.
+import argparse
+import glob
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from cgap_aggregate import compute_critical_values
+from cgap_pipeline import load_cgap_df, rate_columns_of, region_columns_of
+
+
+WORKBOOK_PATTERNS = ['*.xlsx', '*.xlsm']
+# Workbook names whose outputs would overwrite the combined output
+RESERVED_NAMES = {'combined'}
+
+
+def find_workbooks(input_dir):
+    paths = set()
+    for pattern in WORKBOOK_PATTERNS:
+        paths.update(glob.glob(os.path.join(input_dir, pattern)))
+    # Skip the lock files Excel leaves next to open workbooks
+    return sorted(path for path in paths if not os.path.basename(path).startswith('~$'))
+
+
+def output_names(paths):
+    """Return {path: workbook name}, the names the outputs of the workbooks are written under.
+
+    The name is the file name without its extension; the extension is kept (X_xlsm) when
+    several workbooks share the file name or it is reserved. Names are compared ignoring case,
+    as on Windows and macOS file systems. Raises ValueError when they still clash.
+    """
+    stems = {path: os.path.splitext(os.path.basename(path))[0] for path in paths}
+    counts = Counter(stem.lower() for stem in stems.values())
+    names = {}
+    for path, stem in stems.items():
+        if counts[stem.lower()] > 1 or stem.lower() in RESERVED_NAMES:
+            stem = '%s_%s' % (stem, os.path.splitext(path)[1].lstrip('.'))
+        names[path] = stem
+    counts = Counter(name.lower() for name in names.values())
+    clashes = sorted(os.path.basename(path) for path, name in names.items() if counts[name.lower()] > 1)
+    if clashes:
+        raise ValueError('the outputs of %s would overwrite each other: rename the workbooks' % ', '.join(clashes))
+    return names
+
+
+def critical_gaps(cgap_df, zones=None, rates=None):
+    """Critical values of every zone column x rate column combination, stacked in one long table."""
+    frames = []
+    for zone_column in zones or region_columns_of(cgap_df):
+        for rate_column in rates or rate_columns_of(cgap_df):
+            if zone_column not in cgap_df.columns or rate_column not in cgap_df.columns:
+                continue
+            critical_values = compute_critical_values(cgap_df, zone_column, rate_column)
+            critical_values = critical_values.rename(columns={zone_column: 'Zone',
+                                                              rate_column: 'Application rate (g/ha)'})
+            critical_values.insert(0, 'Zone column', zone_column)
+            critical_values.insert(1, 'Rate column', rate_column)
+            frames.append(critical_values)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_output(frame, path, fmt):
+    if fmt == 'csv':
+        frame.to_csv(path, index=False, encoding='utf-8-sig')
+    else:
+        with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+            frame.to_excel(writer, index=False, sheet_name='Critical GAPs')
+
+
+def process_workbook(path, output_dir, zones=None, rates=None, fmt='xlsx', name=None):
+    """Parse one workbook, compute its critical GAPs and write them next to the others.
+
+    name (see output_names) defaults to the file name without its extension.
+    Returns (workbook name, critical GAPs, timings in seconds per stage).
+    """
+    name = name or os.path.splitext(os.path.basename(path))[0]
+    timings = {}
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        decoded = f.read()
+    dataset_key, cgap_df = load_cgap_df(decoded)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    critical = critical_gaps(cgap_df, zones, rates)
+    critical.insert(0, 'Workbook', name)
+    timings['aggregate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_output(critical, os.path.join(output_dir, '%s_critical_gaps.%s' % (name, fmt)), fmt)
+    timings['write'] = time.perf_counter() - start
+    timings['rows'] = len(cgap_df)
+    return name, critical, timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the critical GAPs of every Master GAP workbook in a directory.')
+    parser.add_argument('input_dir', help='directory holding the .xlsx / .xlsm Master GAP workbooks')
+    parser.add_argument('-o', '--output-dir', default='critical_gaps_output', help='where the outputs are written')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--zone', action='append', help='zone column to use (repeatable, default: all)')
+    parser.add_argument('--rate', action='append', help='application rate column to use (repeatable, default: all)')
+    parser.add_argument('--format', choices=['xlsx', 'csv'], default='xlsx', help='output format')
+    args = parser.parse_args(argv)
+
+    paths = find_workbooks(args.input_dir)
+    if not paths:
+        print('No workbook found in', args.input_dir)
+        return 1
+    try:
+        names = output_names(paths)
+    except ValueError as e:
+        print('Cannot process %s: %s' % (args.input_dir, e))
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    total_start = time.perf_counter()
+    results, timings, failures = [], [], []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_workbook, path, args.output_dir, args.zone, args.rate, args.format,
+                                   names[path]): path
+                   for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                name, critical, timing = future.result()
+            except Exception as e:
+                failures.append(path)
+                print('FAILED  %s: %s: %s' % (os.path.basename(path), type(e).__name__, e))
+                continue
+            results.append(critical)
+            timings.append(dict(workbook=name, **timing))
+            print('done    %-60s %6d rows  parse %6.2fs  aggregate %6.2fs  write %6.2fs'
+                  % (name[:60], timing['rows'], timing['parse'], timing['aggregate'], timing['write']))
+
+    if results:
+        combined = pd.concat(results, ignore_index=True)
+        write_output(combined, os.path.join(args.output_dir, 'combined_critical_gaps.%s' % args.format), args.format)
+        pd.DataFrame(timings).to_csv(os.path.join(args.output_dir, 'timings.csv'), index=False)
+    print('%d workbooks processed, %d failed, in %.2fs' % (len(results), len(failures), time.perf_counter() - total_start))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
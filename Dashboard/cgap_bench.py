@@ -0,0 +1,191 @@
+# Stage-level benchmark of the cGAP pipeline on synthetic Master GAP tables.
+#
+#   python Dashboard/cgap_bench.py --sizes 10000 100000 1000000 5000000
+#   python Dashboard/cgap_bench.py --sizes 10000 100000 --compare bench_results/<previous run>.json
+#   python Dashboard/cgap_bench.py --startup --sizes
+#
+# Times each stage separately (Excel parse, column resolution, crop normalization, groupby,
+# filtering, DataTable and export serialization) and saves the results as JSON. --startup
+# also breaks down the import time of the WSGI entry point by top-level package.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from cgap_aggregate import compute_critical_values
+from cgap_export import write_csv, write_parquet, write_xlsx
+from cgap_filter import FilterIndex, page
+from cgap_pipeline import group_crops, load_crop_rules, read_master_gap, select_cgap_columns
+from cgap_synth import EXCEL_MAX_ROWS, make_master_gap_frame, write_master_gap_workbook
+from cgap_wire import encode_frame
+
+
+ZONE_COLUMN = 'Regulatory Zone'
+RATE_COLUMN = 'Application rate PTZ (g/ha)'
+
+
+def time_stage(fn, repeat):
+    """Run fn repeat times; return (last result, list of durations in seconds)."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return result, durations
+
+
+def random_selections(index_frame, n, seed=0):
+    rng = np.random.default_rng(seed)
+    choices = {col: index_frame[col].dropna().unique() for col in ['Product(PLT short)', 'Crop', ZONE_COLUMN]}
+    selections = []
+    for _ in range(n):
+        selection = {}
+        for col, values in choices.items():
+            if rng.random() < 0.5 or not len(values):
+                selection[col] = ['All']
+            else:
+                selection[col] = list(rng.choice(values, size=min(len(values), rng.integers(1, 4)), replace=False))
+        selections.append(selection)
+    return selections
+
+
+def bench_size(n_rows, repeat, max_excel_rows, record):
+    raw = make_master_gap_frame(n_rows)
+
+    if n_rows <= min(max_excel_rows, EXCEL_MAX_ROWS):
+        workbook = write_master_gap_workbook(raw)
+        raw_parsed, durations = time_stage(lambda: read_master_gap(workbook), repeat)
+        record('excel parse', n_rows, durations, bytes=len(workbook))
+        del workbook, raw_parsed
+
+    cgap_df, durations = time_stage(lambda: select_cgap_columns(raw), repeat)
+    record('column resolution', n_rows, durations)
+
+    rules = load_crop_rules()
+    cgap_df, durations = time_stage(lambda: group_crops(select_cgap_columns(raw), rules), repeat)
+    _, baseline = time_stage(lambda: select_cgap_columns(raw), repeat)
+    record('crop normalization', n_rows, [max(0.0, total - select) for total, select in zip(durations, baseline)])
+    del raw
+
+    critical, durations = time_stage(lambda: compute_critical_values(cgap_df, ZONE_COLUMN, RATE_COLUMN), repeat)
+    record('groupby', n_rows, durations, groups=len(critical))
+
+    index, durations = time_stage(lambda: FilterIndex(critical, ['Product(PLT short)', 'Crop', ZONE_COLUMN]), repeat)
+    record('filter index build', n_rows, durations)
+    selections = random_selections(critical, 50)
+    _, durations = time_stage(lambda: [index.select(selection) for selection in selections], repeat)
+    record('filtering (50 selections)', n_rows, durations)
+
+    def serialize_page():
+        rows, _ = page(critical, 0, 100)
+        return json.dumps(rows.to_dict('records'), default=str)
+    payload, durations = time_stage(serialize_page, repeat)
+    record('datatable page serialization', n_rows, durations, bytes=len(payload))
+    payload, durations = time_stage(lambda: json.dumps(critical.to_dict('records'), default=str), repeat)
+    record('datatable full serialization', n_rows, durations, bytes=len(payload))
+    payload, durations = time_stage(lambda: json.dumps(encode_frame(critical)), repeat)
+    record('columnar store serialization', n_rows, durations, bytes=len(payload))
+
+    for name, writer in [('export csv', write_csv), ('export parquet', write_parquet), ('export xlsx', write_xlsx)]:
+        content, durations = time_stage(lambda: writer(critical), repeat)
+        record(name, n_rows, durations, bytes=len(content))
+
+
+def import_times():
+    """Import wsgi in a fresh interpreter; return {top-level module: cumulative seconds}."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import wsgi'], cwd=here,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr.decode()
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # Every module is imported once: a package's first line covers everything it pulled in
+        if cumulative.strip().isdigit() and '.' not in name:
+            times[name] = int(cumulative) / 1e6
+    return times
+
+
+def bench_startup(repeat, record, top=12):
+    runs = [import_times() for _ in range(repeat)]
+    record('startup import wsgi', 0, [run['wsgi'] for run in runs])
+    slowest = sorted(runs[-1], key=runs[-1].get, reverse=True)
+    for name in [name for name in slowest if name != 'wsgi'][:top]:
+        record('startup import ' + name, 0, [run.get(name, 0.0) for run in runs])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['rows']): r for r in json.load(f)['results']}
+    print('\n%-40s %10s %12s %12s %8s' % ('stage', 'rows', 'baseline s', 'current s', 'ratio'))
+    for r in results:
+        previous = baseline.get((r['stage'], r['rows']))
+        if previous is None:
+            continue
+        ratio = r['median'] / previous['median'] if previous['median'] else float('nan')
+        print('%-40s %10d %12.4f %12.4f %7.2fx' % (r['stage'], r['rows'], previous['median'], r['median'], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the cGAP pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000], help='numbers of GAP rows')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage')
+    parser.add_argument('--max-excel-rows', type=int, default=100000,
+                        help='skip the Excel parse stage above this size (writing the workbook is slow)')
+    parser.add_argument('--output-dir', default='bench_results', help='where the JSON results are saved')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--startup', action='store_true',
+                        help='also time the app import, broken down by top-level package (cumulative, so nested)')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    def record(stage, rows, durations, **extra):
+        result = dict(stage=stage, rows=rows, min=min(durations), median=statistics.median(durations), **extra)
+        results.append(result)
+        print('%-40s %10d rows  median %9.4fs  min %9.4fs%s' % (
+            stage, rows, result['median'], result['min'],
+            '  %d bytes' % extra['bytes'] if 'bytes' in extra else ''))
+
+    if args.startup:
+        bench_startup(args.repeat, record)
+    for n_rows in args.sizes:
+        bench_size(n_rows, args.repeat, args.max_excel_rows, record)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, 'cgap_bench_%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w') as f:
+        json.dump({
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print('results saved to', path)
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# Persistent on-disk cache of normalized cgap_df frames, keyed by a hash of the uploaded workbook bytes.
+# Frames are stored as Arrow IPC files so a repeated upload of the same Master GAP version
+# skips the openpyxl parse completely. The files are uncompressed and memory-mapped on read, so
+# every worker process maps the same pages instead of holding its own copy of the columns.
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+# Bump when the normalization in cgap_pipeline changes, so stale entries are never served
+CACHE_VERSION = '4'
+CACHE_DIR = os.environ.get('CGAP_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cgap_cache'))
+CACHE_MAX_BYTES = int(float(os.environ.get('CGAP_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+# 'lz4' or 'zstd' shrink the files but every read then decompresses into private memory
+COMPRESSION = os.environ.get('CGAP_CACHE_COMPRESSION') or None
+
+# Object columns mixing numbers and text (e.g. rate columns holding '-' or 'STOP') are stored
+# as a float column plus a text column and stitched back together on read
+_NUM_SUFFIX = '\x00num'
+_TXT_SUFFIX = '\x00txt'
+_SPLIT_META = b'cgap_split_columns'
+_ORDER_META = b'cgap_columns'
+
+
+def content_key(decoded, salt=''):
+    """Cache key of the uploaded bytes; salt covers the settings the normalization depends on."""
+    key = hashlib.sha256(decoded).hexdigest()
+    if salt:
+        key += '-' + hashlib.sha256(salt.encode('utf-8')).hexdigest()[:12]
+    return key + '-v' + CACHE_VERSION
+
+
+def derived_key(key, *parts):
+    """Cache key of a result computed from the dataset cached under key (e.g. its critical values)."""
+    return '%s-%s' % (key, hashlib.sha256('\x01'.join(parts).encode('utf-8')).hexdigest()[:16])
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key + '.arrow')
+
+
+def _split_mixed(df):
+    import pyarrow as pa
+
+    columns, split = {}, []
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object:
+            try:
+                pa.array(values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                is_text = values.map(lambda v: isinstance(v, str))
+                columns[col + _NUM_SUFFIX] = pd.to_numeric(values.where(~is_text), errors='coerce').astype('float64')
+                columns[col + _TXT_SUFFIX] = values.where(is_text, None).astype(object)
+                split.append(col)
+                continue
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index), split
+
+
+def _join_mixed(df, split):
+    for col in split:
+        # Put back in place of its two halves: reordering the frame afterwards would copy every column
+        loc = df.columns.get_loc(col + _NUM_SUFFIX)
+        num_codes, numbers = pd.factorize(df.pop(col + _NUM_SUFFIX))
+        txt_codes, texts = pd.factorize(df.pop(col + _TXT_SUFFIX))
+        # One Python object per distinct value (a rate column holds a few dozen), shared by the
+        # rows, instead of boxing every cell; the last slot is the missing value (code -1)
+        objects = np.empty(len(numbers) + len(texts) + 1, dtype=object)
+        for position, number in enumerate(numbers):
+            # Whole numbers come back as int, the way openpyxl returned them
+            objects[position] = int(number) if np.isfinite(number) and number == np.floor(number) else float(number)
+        objects[len(numbers):-1] = list(texts)
+        objects[-1] = np.nan
+        df.insert(loc, col, objects[np.where(txt_codes >= 0, len(numbers) + txt_codes, num_codes)])
+    return df
+
+
+def get(key):
+    """Return the cached cgap_df for key, or None on a miss."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    path = _path(key)
+    try:
+        # Uncompressed buffers stay in the mapped file: numeric columns without nulls are not copied
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+    # Touch the entry so eviction drops the least recently used files first
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    metadata = table.schema.metadata or {}
+    split = [col for col in metadata.get(_SPLIT_META, b'').decode('utf-8').split('\x01') if col]
+    order = metadata[_ORDER_META].decode('utf-8').split('\x01')
+    # Reorder the Arrow table, not the frame: a pandas reindex would copy every column
+    table = table.select([part for col in order
+                          for part in ([col + _NUM_SUFFIX, col + _TXT_SUFFIX] if col in split else [col])])
+    return _join_mixed(table.to_pandas(split_blocks=True), split)
+
+
+def put(key, cgap_df):
+    """Write cgap_df under key, then evict old entries beyond CACHE_MAX_BYTES."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    frame, split = _split_mixed(cgap_df.reset_index(drop=True))
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type):
+            # Keep NaN as a value rather than an Arrow null: a column with nulls cannot be read zero-copy
+            table = table.set_column(i, field, pa.array(frame[field.name].to_numpy(), type=field.type, from_pandas=False))
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        _SPLIT_META: '\x01'.join(split).encode('utf-8'),
+        _ORDER_META: '\x01'.join(cgap_df.columns).encode('utf-8'),
+    })
+    path = _path(key)
+    # One temporary file per writer: threads of a worker may write the same key at once
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION)) as writer:
+            writer.write_table(table)
+    # Atomic rename so a concurrent reader never sees a half-written file
+    os.replace(tmp_path, path)
+    evict()
+
+
+def evict(max_bytes=None):
+    """Delete the least recently used entries until the cache fits in max_bytes."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    try:
+        entries = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR) if name.endswith('.arrow')]
+    except OSError:
+        return
+    stats = []
+    for path in entries:
+        try:
+            stats.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            pass
+    total = sum(size for _, size, _ in stats)
+    for _, size, path in sorted(stats):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,113 @@
+# Export of the (filtered) critical values, with an LRU cache of the produced files so that
+# repeated clicks on "Export Data" for the same dataset and selections are served instantly.
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import cgap_metrics
+from cgap_filter import is_unfiltered
+
+
+EXPORT_FORMATS = {
+    'xlsx': ('Excel (.xlsx)', 'xlsx'),
+    'csv': ('CSV (.csv)', 'csv'),
+    'parquet': ('Parquet (.parquet)', 'parquet'),
+    'arrow': ('Arrow IPC / Feather (.arrow)', 'arrow'),
+}
+EXPORT_CACHE_MAX_BYTES = int(float(os.environ.get('CGAP_EXPORT_CACHE_MB', '64')) * 1024 * 1024)
+
+_artifacts = OrderedDict()
+_artifacts_bytes = 0
+_lock = threading.Lock()
+
+
+def selection_key(selection):
+    # None, [] and ['All'] all mean "no filter"; the order of the selected values does not matter
+    return None if is_unfiltered(selection) else tuple(sorted(str(value) for value in selection))
+
+
+def write_xlsx(frame, sheet_name='Sheet1'):
+    """Write frame to xlsx bytes row by row with xlsxwriter's constant_memory mode."""
+    import xlsxwriter
+
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True})
+    worksheet.write_row(0, 0, [str(col) for col in frame.columns], header_format)
+    for row_number, row in enumerate(frame.itertuples(index=False, name=None), start=1):
+        # xlsxwriter cannot write NaN: leave those cells blank
+        worksheet.write_row(row_number, 0, [None if pd.isna(value) else value for value in row])
+    workbook.close()
+    return output.getvalue()
+
+
+def write_csv(frame):
+    return frame.to_csv(index=False).encode('utf-8-sig')
+
+
+def _arrow_table(frame):
+    import pyarrow as pa
+
+    columns = {}
+    for col in frame.columns:
+        values = frame[col]
+        if values.dtype == object:
+            try:
+                pa.array(values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Numbers mixed with text such as '-' have no single Arrow type: keep them as text
+                values = values.where(values.isna(), values.astype(str))
+        columns[str(col)] = values
+    return pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+
+
+def write_parquet(frame):
+    import pyarrow.parquet as pq
+
+    output = io.BytesIO()
+    pq.write_table(_arrow_table(frame), output)
+    return output.getvalue()
+
+
+def write_arrow(frame):
+    import pyarrow as pa
+
+    table = _arrow_table(frame)
+    output = io.BytesIO()
+    with pa.ipc.new_file(output, table.schema) as writer:
+        writer.write_table(table)
+    return output.getvalue()
+
+
+WRITERS = {'xlsx': write_xlsx, 'csv': write_csv, 'parquet': write_parquet, 'arrow': write_arrow}
+
+
+def write_export(frame, fmt):
+    """Serialize frame in one of EXPORT_FORMATS; the columnar formats are written straight from the columns."""
+    with cgap_metrics.span('export ' + fmt) as span:
+        content = WRITERS[fmt](frame)
+        span.update(rows=len(frame), bytes=len(content))
+    return content
+
+
+def cached_artifact(key, build):
+    """Return the bytes cached under key, building and caching them on a miss."""
+    global _artifacts_bytes
+    with _lock:
+        if key in _artifacts:
+            _artifacts.move_to_end(key)
+            return _artifacts[key]
+    content = build()
+    with _lock:
+        if key not in _artifacts:
+            _artifacts[key] = content
+            _artifacts_bytes += len(content)
+        _artifacts.move_to_end(key)
+        while _artifacts_bytes > EXPORT_CACHE_MAX_BYTES and len(_artifacts) > 1:
+            _, evicted = _artifacts.popitem(last=False)
+            _artifacts_bytes -= len(evicted)
+    return content
@@ -0,0 +1,131 @@
+# Indexed product / crop / region filtering of a critical-values frame.
+# Each filter column is factorized once into categorical codes with the sorted row positions of
+# every value, so any combination of selections resolves with a few array intersections.
+import numpy as np
+import pandas as pd
+
+
+def is_unfiltered(selection):
+    # The dropdowns send None before first use, [] when cleared and ['All'] for the "All" option
+    return selection is None or selection == [] or selection == ['All']
+
+
+class FilterIndex:
+    """Per-value row positions of the filter columns of a frame."""
+
+    def __init__(self, frame, columns):
+        self.frame = frame
+        self._positions = {}
+        for col in columns:
+            codes, uniques = pd.factorize(frame[col])
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self._positions[col] = {value: order[bounds[code]:bounds[code + 1]]
+                                    for code, value in enumerate(uniques)}
+
+    def rows(self, col, values):
+        """Sorted row positions where col takes any of values."""
+        positions = self._positions[col]
+        found = [positions[value] for value in values if value in positions]
+        if not found:
+            return np.empty(0, dtype=np.intp)
+        if len(found) == 1:
+            return found[0]
+        return np.sort(np.concatenate(found))
+
+    def select(self, selections):
+        """Return the rows of the frame matching every {column: selected values} pair."""
+        rows = None
+        for col, values in selections.items():
+            if is_unfiltered(values):
+                continue
+            matched = self.rows(col, values)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        if rows is None:
+            return self.frame
+        return self.frame.take(rows)
+
+
+# Server-side paging, sorting and filtering of the DataTable (page_action / sort_action / filter_action = 'custom')
+FILTER_OPERATORS = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    """Split one '{column} op value' clause of a DataTable filter_query into (column, op, value)."""
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                quote = value_part[:1]
+                if quote and quote == value_part[-1] and quote in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + quote, quote)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def apply_filter_query(frame, filter_query):
+    if not filter_query:
+        return frame
+    for filter_part in filter_query.split(' && '):
+        col, operator, value = split_filter_part(filter_part)
+        if col not in frame.columns:
+            continue
+        values = frame[col]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if isinstance(value, float):
+                # GAP columns mix numbers with text such as '-': compare the numeric part only
+                values = pd.to_numeric(values, errors='coerce')
+            else:
+                values = values.astype(str)
+            mask = {'eq': values == value, 'ne': values != value,
+                    'lt': values < value, 'le': values <= value,
+                    'gt': values > value, 'ge': values >= value}[operator]
+        elif operator == 'contains':
+            mask = values.astype(str).str.contains(str(value), case=False, regex=False)
+        elif operator == 'datestartswith':
+            mask = values.astype(str).str.startswith(str(value))
+        else:
+            continue
+        frame = frame[mask]
+    return frame
+
+
+def apply_sort(frame, sort_by):
+    if not sort_by:
+        return frame
+    columns = [sort['column_id'] for sort in sort_by if sort['column_id'] in frame.columns]
+    ascending = [sort['direction'] == 'asc' for sort in sort_by if sort['column_id'] in frame.columns]
+    if not columns:
+        return frame
+    # Mixed numbers and text (e.g. rates and '-') do not always raise but sort inconsistently:
+    # always sort on the numeric part, text and missing cells last (as assets/cgap_table.js does)
+    return frame.sort_values(columns, ascending=ascending, kind='mergesort', key=_mixed_sort_key)
+
+
+def _mixed_sort_key(values):
+    numeric = pd.to_numeric(values, errors='coerce')
+    if numeric.notna().any():
+        return numeric
+    return values.astype(str).where(values.notna())
+
+
+def page(frame, page_current, page_size):
+    """Return (rows of the current page, page count), clamping page_current to the last page."""
+    page_size = page_size or 100
+    page_count = max(1, -(-len(frame) // page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    return frame.iloc[page_current * page_size:(page_current + 1) * page_size], page_count
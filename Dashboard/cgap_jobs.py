@@ -0,0 +1,189 @@
+# Background ingestion jobs: parse and normalize uploaded workbooks in a worker process pool
+# and report stage-level progress ('read', 'normalize', 'crop grouping', 'ready') that the UI polls.
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import cgap_cache
+import cgap_metrics
+import cgap_preflight
+from cgap_pipeline import load_cgap_df, merge_cgap_frames
+
+
+STAGES = ['queued', 'read', 'normalize', 'crop grouping', 'ready']
+BACKGROUND = os.environ.get('CGAP_BACKGROUND_JOBS', '1') != '0'
+# Workbooks uploaded together are parsed concurrently, one per worker
+MAX_WORKERS = int(os.environ.get('CGAP_INGEST_WORKERS', str(min(4, os.cpu_count() or 1))))
+JOBS_DIR = os.path.join(cgap_cache.CACHE_DIR, 'jobs')
+# Status files of finished jobs are removed after this many seconds
+JOB_TTL_SECONDS = 3600
+
+_executor = None
+
+
+def _status_path(job_id):
+    return os.path.join(JOBS_DIR, job_id + '.json')
+
+
+def _write_status(job_id, **status):
+    # Status lives on disk so the worker process (and any web worker) can report and read it
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    status['updated'] = time.time()
+    tmp_path = '%s.%d.tmp' % (_status_path(job_id), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, _status_path(job_id))
+
+
+def _run_job(job_id, decoded):
+    try:
+        with cgap_metrics.recorded() as spans:
+            key, cgap_df = load_cgap_df(decoded, progress=lambda stage: _write_status(job_id, stage=stage))
+    except Exception as e:
+        _write_status(job_id, stage='failed', error='%s: %s' % (type(e).__name__, e))
+        raise
+    # Stage timings of a worker process are reported through the status file; the frame itself
+    # is read back from the dataset cache by whichever web worker collects the job
+    _write_status(job_id, stage='ready', dataset_token=key, spans=spans)
+    return key
+
+
+def _job_done(job_id, error):
+    # A worker that died before it could record its failure (e.g. a broken process pool)
+    if error is not None and status(job_id)['stage'] != 'failed':
+        _write_status(job_id, stage='failed', error='%s: %s' % (type(error).__name__, error))
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Never fork the threaded web process: a child would inherit the locks (cgap_metrics,
+        # cgap_aggregate) its other threads hold at that moment and block on them for good
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def _cleanup():
+    try:
+        names = os.listdir(JOBS_DIR)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_TTL_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def submit(decoded, name=None):
+    """Start ingesting the uploaded bytes and return the job id right away.
+
+    A file that is not a usable Master GAP workbook fails at once, without taking a worker.
+    With CGAP_BACKGROUND_JOBS=0 the job runs inline and is ready when this returns.
+    """
+    _cleanup()
+    job_id = uuid.uuid4().hex
+    try:
+        with cgap_metrics.span('preflight'):
+            cgap_preflight.check_workbook(decoded)
+    except ValueError as e:
+        _write_status(job_id, stage='failed', error=str(e) if name is None else '%s: %s' % (name, e))
+        return job_id
+    _write_status(job_id, stage='queued')
+    if BACKGROUND:
+        # No reference to the future is kept: the job is collected through its status file
+        future = _get_executor().submit(_run_job, job_id, decoded)
+        future.add_done_callback(lambda future: _job_done(job_id, future.exception()))
+    else:
+        try:
+            _run_job(job_id, decoded)
+        except Exception as e:
+            _job_done(job_id, e)
+    return job_id
+
+
+def submit_many(decoded_files, names=None):
+    """Start one ingestion job per workbook and return the id of the job merging them.
+
+    The workbooks are parsed concurrently by the pool; the merged dataset is ready once
+    the slowest of them is. names (e.g. the file names) label the errors of each workbook.
+    """
+    # The same workbook selected twice is parsed once
+    named = dict(zip(decoded_files, names or [None] * len(decoded_files)))
+    if len(named) == 1:
+        return submit(*next(iter(named.items())))
+    job_id = uuid.uuid4().hex
+    children = [submit(decoded, name) for decoded, name in named.items()]
+    _write_status(job_id, stage='queued', children=children)
+    return job_id
+
+
+def _group_status(job):
+    children = [status(child) for child in job['children']]
+    failed = [child for child in children if child['stage'] == 'failed']
+    if failed:
+        return dict(job, stage='failed', error=failed[0].get('error', ''), progress=100)
+    pending = [child['stage'] for child in children if child['stage'] != 'ready']
+    # Report the least advanced workbook
+    stage = min(pending, key=lambda stage: STAGES.index(stage) if stage in STAGES else 0) if pending else 'ready'
+    return dict(job, stage=stage, progress=int(sum(child['progress'] for child in children) / len(children)),
+                workbooks_ready='%d/%d' % (len(children) - len(pending), len(children)))
+
+
+def status(job_id):
+    """Return the job status dict: stage, progress (0-100), and dataset_token or error."""
+    try:
+        with open(_status_path(job_id)) as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return {'stage': 'unknown', 'progress': 0}
+    if 'children' in job:
+        return _group_status(job)
+    if job['stage'] in STAGES:
+        job['progress'] = int(100 * STAGES.index(job['stage']) / (len(STAGES) - 1))
+    else:
+        job['progress'] = 100
+    return job
+
+
+def result(job_id):
+    """Return (dataset_token, cgap_df) of a ready job, or None if it is not ready."""
+    job = status(job_id)
+    if job['stage'] != 'ready':
+        return None
+    if 'children' in job:
+        return _merge_results(job['children'])
+    if BACKGROUND:
+        cgap_metrics.replay(job.get('spans'))
+    # The parsed frame is mapped from the shared dataset cache, wherever the job ran
+    cgap_df = cgap_cache.get(job['dataset_token'])
+    if cgap_df is None:
+        _write_status(job_id, stage='failed', error='the parsed workbook is no longer cached: upload it again')
+        return None
+    return job['dataset_token'], cgap_df
+
+
+def _merge_results(children):
+    results = [result(child) for child in children]
+    if any(ready is None for ready in results):
+        return None
+    results.sort(key=lambda ready: ready[0])
+    key = cgap_cache.content_key('\n'.join(dataset_key for dataset_key, _ in results).encode('utf-8'), 'merged')
+    cgap_df = cgap_cache.get(key)
+    if cgap_df is None:
+        with cgap_metrics.span('merge workbooks') as span:
+            cgap_df = merge_cgap_frames([frame for _, frame in results])
+            span['rows'] = len(cgap_df)
+        cgap_cache.put(key, cgap_df)
+        # Serve the mapped file rather than the frame just built, like any other worker would;
+        # the built frame is only kept when the cache cannot hold it
+        cached = cgap_cache.get(key)
+        cgap_df = cgap_df if cached is None else cached
+    return key, cgap_df
@@ -0,0 +1,184 @@
+# Timing spans of the dashboard callbacks and pipeline stages, exposed in the Prometheus text
+# format on the /metrics route of the Flask server. Every span records its duration and, when
+# known, the number of rows it produced; callback responses also record their payload size.
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+QUANTILES = [0.5, 0.9, 0.99]
+# Latest observations kept per series for the quantiles
+WINDOW = int(os.environ.get('CGAP_METRICS_WINDOW', '1024'))
+
+logger = logging.getLogger('cgap')
+
+_lock = threading.Lock()
+_local = threading.local()
+_summaries = {}
+_counters = {}
+_recorders = []
+
+HELP = {
+    'cgap_callback_duration_seconds': ('summary', 'Time spent in the dashboard callbacks.'),
+    'cgap_callback_rows_total': ('counter', 'Rows produced by the dashboard callbacks.'),
+    'cgap_callback_payload_bytes': ('summary', 'Size of the callback responses sent to the browser.'),
+    'cgap_callback_requests_total': ('counter', 'Server callback requests, by the input change that triggered them.'),
+    'cgap_stage_duration_seconds': ('summary', 'Time spent in the pipeline stages.'),
+    'cgap_stage_rows_total': ('counter', 'Rows produced by the pipeline stages.'),
+    'cgap_stage_payload_bytes': ('summary', 'Size of the files produced by the pipeline stages.'),
+}
+
+
+class _Summary:
+    def __init__(self):
+        self.values = deque(maxlen=WINDOW)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantiles(self):
+        values = sorted(self.values)
+        if not values:
+            return [(q, float('nan')) for q in QUANTILES]
+        return [(q, values[min(len(values) - 1, int(q * len(values)))]) for q in QUANTILES]
+
+
+def _observe_summary(metric, label, name, value):
+    with _lock:
+        _summaries.setdefault((metric, label, name), _Summary()).observe(value)
+
+
+def _increment(metric, label, name, value):
+    with _lock:
+        _counters[(metric, label, name)] = _counters.get((metric, label, name), 0) + value
+
+
+def observe(kind, name, seconds, rows=None, payload_bytes=None):
+    """Record one finished span; kind is 'callback' or 'stage'."""
+    _observe_summary('cgap_%s_duration_seconds' % kind, kind, name, seconds)
+    if rows is not None:
+        _increment('cgap_%s_rows_total' % kind, kind, name, rows)
+    if payload_bytes is not None:
+        _observe_summary('cgap_%s_payload_bytes' % kind, kind, name, payload_bytes)
+    for recorder in list(_recorders):
+        if recorder['thread'] == threading.get_ident():
+            recorder['spans'].append([kind, name, seconds, rows, payload_bytes])
+    logger.debug('%s %s: %.4fs rows=%s bytes=%s', kind, name, seconds, rows, payload_bytes)
+
+
+def observe_payload(kind, name, payload_bytes):
+    _observe_summary('cgap_%s_payload_bytes' % kind, kind, name, payload_bytes)
+
+
+@contextmanager
+def span(name, kind='stage'):
+    """Time the enclosed block; the yielded dict takes optional 'rows' and 'bytes' entries."""
+    attributes = {}
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(attributes)
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        observe(kind, name, elapsed, attributes.get('rows'), attributes.get('bytes'))
+
+
+def annotate(**attributes):
+    """Attach rows / bytes to the innermost open span of this thread."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].update(attributes)
+
+
+def timed_callback(name):
+    """Decorator running a Dash callback inside a 'callback' span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, kind='callback'):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def recorded():
+    """Collect the spans finished by this thread in the block, to report them from another process."""
+    recorder = {'thread': threading.get_ident(), 'spans': []}
+    with _lock:
+        _recorders.append(recorder)
+    try:
+        yield recorder['spans']
+    finally:
+        with _lock:
+            _recorders.remove(recorder)
+
+
+def replay(spans):
+    """Record spans collected by recorded() in a worker process."""
+    for kind, name, seconds, rows, payload_bytes in spans or []:
+        observe(kind, name, seconds, rows, payload_bytes)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """Return every series in the Prometheus text exposition format."""
+    with _lock:
+        summaries = {key: (summary.quantiles(), summary.total, summary.count) for key, summary in _summaries.items()}
+        counters = dict(_counters)
+    lines = []
+    for metric, (metric_type, help_text) in HELP.items():
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        for (series_metric, label, name), (quantiles, total, count) in sorted(summaries.items()):
+            if series_metric != metric:
+                continue
+            labels = '%s="%s"' % (label, _escape(name))
+            for q, value in quantiles:
+                lines.append('%s{%s,quantile="%s"} %r' % (metric, labels, q, float(value)))
+            lines.append('%s_sum{%s} %r' % (metric, labels, float(total)))
+            lines.append('%s_count{%s} %d' % (metric, labels, count))
+        for (series_metric, label, name), value in sorted(counters.items()):
+            if series_metric == metric:
+                lines.append('%s{%s="%s"} %r' % (metric, label, _escape(name), float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def install(app):
+    """Serve /metrics on the Dash app's Flask server and record the size of every callback response.
+
+    Callback requests are also counted by triggering input: a user action should cost a single
+    server request, whatever the clientside callbacks do with it.
+    """
+    import flask
+
+    server = app.server
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def record_payload(response):
+        if not flask.request.path.endswith('/_dash-update-component'):
+            return response
+        body = flask.request.get_json(silent=True) or {}
+        _increment('cgap_callback_requests_total', 'trigger', ','.join(body.get('changedPropIds') or ['initial']), 1)
+        if response.status_code == 200 and not response.direct_passthrough:
+            callback = app.callback_map.get(body.get('output'), {}).get('callback')
+            name = getattr(callback, '__name__', body.get('output'))
+            observe_payload('callback', name, len(response.get_data()))
+        return response
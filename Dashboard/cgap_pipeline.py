@@ -0,0 +1,181 @@
+# Ingestion pipeline for the "Master GAP Table" workbooks: read the MasterGAP sheet
+# and normalize it into the cgap_df frame used by the dashboards
+import base64
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import cgap_cache
+import cgap_metrics
+import cgap_schema
+from cgap_schema import ZONE_COLUMNS, is_rate_column
+
+
+# Rows 1-6 of the current MasterGAP template document it and the column titles sit on row 7;
+# cgap_schema finds them in other layouts too
+HEADER_ROW = 7
+# Template rows after this marker row are placeholders, not GAPs
+STOP_MARKER = 'STOP'
+# Crop exclusions and groupings; see crop_rules.json
+CROP_RULES_PATH = os.environ.get('CGAP_CROP_RULES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crop_rules.json'))
+# Formatted but empty rows at the bottom of a sheet are still stored; give up after this many
+MAX_EMPTY_ROWS = 10000
+
+
+def decode_upload(contents):
+    # dcc.Upload contents look like 'data:<mime>;base64,<payload>'
+    content_type, content_string = contents.split(',')
+    return base64.b64decode(content_string)
+
+
+def read_master_gap(decoded):
+    """Stream the MasterGAP sheet in read-only mode, keeping only the cGAP columns.
+
+    The header row and the columns are resolved from the first rows (see cgap_schema); rows
+    are then read up to the 'STOP' marker row (or the end of the sheet), so the ~130 unused
+    columns are never materialized in a DataFrame. The columns get their canonical names.
+    """
+    # Imported here: the web process only needs openpyxl once a workbook is uploaded
+    import openpyxl
+
+    wb = openpyxl.load_workbook(BytesIO(decoded), read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb['MasterGAP']
+        header_row, columns = cgap_schema.resolve(list(ws.iter_rows(max_row=cgap_schema.SCAN_ROWS, values_only=True)))
+        names, indexes = list(columns.values()), list(columns)
+
+        records = []
+        last_data_row = 0
+        # Cells right of the last projected column are never turned into Python objects
+        for row in ws.iter_rows(min_row=header_row + 1, max_col=max(indexes, default=0) + 1, values_only=True):
+            values = [row[idx] if idx < len(row) else None for idx in indexes]
+            filled = [value for value in values if value is not None]
+            if filled and all(value == STOP_MARKER for value in filled):
+                break
+            records.append(values)
+            if filled:
+                last_data_row = len(records)
+            elif len(records) - last_data_row > MAX_EMPTY_ROWS:
+                break
+    finally:
+        wb.close()
+    # Drop trailing empty rows
+    return pd.DataFrame.from_records(records[:last_data_row], columns=names)
+
+
+def select_cgap_columns(df):
+    """Keep the cGAP columns of a MasterGAP frame, in order and under their canonical names."""
+    columns = cgap_schema.map_columns(list(df.columns))
+    cgap_df = df.iloc[:, list(columns)].copy()
+    cgap_df.columns = list(columns.values())
+    return cgap_df
+
+
+def load_crop_rules(path=None):
+    """Read the crop rules: 'exclude' lists case-insensitive substrings of crops to discard,
+    'groups' lists {'name', 'contains'} entries merging every crop containing one of the
+    (case-sensitive) substrings into the group name; the first matching group wins."""
+    with open(path or CROP_RULES_PATH) as f:
+        return json.load(f)
+
+
+def crop_rules_fingerprint(rules=None):
+    return json.dumps(rules or load_crop_rules(), sort_keys=True)
+
+
+def map_crop(crop, rules):
+    """Return the group name of crop, or None if the crop is excluded."""
+    lowered = crop.lower()
+    if any(pattern.lower() in lowered for pattern in rules.get('exclude', [])):
+        return None
+    for group in rules.get('groups', []):
+        if any(pattern in crop for pattern in group['contains']):
+            return group['name']
+    return crop
+
+
+def group_crops(cgap_df, rules=None):
+    """Discard the excluded crops and merge crop variants into their group.
+
+    The rules are evaluated once per distinct crop string and mapped back to the rows
+    through the factorized codes; the result is a categorical 'Crop' column.
+    """
+    rules = rules or load_crop_rules()
+    codes, crops = pd.factorize(cgap_df['Crop'].fillna(''))
+    mapped = [map_crop(crop, rules) for crop in crops]
+
+    categories = sorted({name for name in mapped if name is not None})
+    position = {name: code for code, name in enumerate(categories)}
+    category_codes = np.array([-1 if name is None else position[name] for name in mapped] or [-1], dtype=np.int64)
+    row_codes = category_codes[codes]
+    keep = row_codes >= 0
+
+    cgap_df = cgap_df[keep].reset_index(drop=True)
+    cgap_df['Crop'] = pd.Categorical.from_codes(row_codes[keep], categories=categories)
+    return cgap_df
+
+
+def normalize_cgap(df):
+    return group_crops(select_cgap_columns(df))
+
+
+def region_columns_of(cgap_df):
+    return [col for col in cgap_df.columns if col.lower() in [name.lower() for name in ZONE_COLUMNS]]
+
+
+def rate_columns_of(cgap_df):
+    return [col for col in cgap_df.columns if is_rate_column(col)]
+
+
+def merge_cgap_frames(frames):
+    """Stack the cgap_df of several workbooks into one dataset without duplicate GAPs.
+
+    Columns are matched case-insensitively (the first workbook's spelling wins); columns
+    missing from a workbook are left empty for its rows.
+    """
+    names = {}
+    for frame in frames:
+        for col in frame.columns:
+            names.setdefault(col.lower(), col)
+    aligned = [frame.rename(columns={col: names[col.lower()] for col in frame.columns}) for frame in frames]
+    merged = pd.concat(aligned, ignore_index=True, sort=False)
+    # The same GAP listed by two regional managers is kept once
+    merged = merged.drop_duplicates(ignore_index=True)
+    # Each workbook has its own crop categories
+    merged['Crop'] = merged['Crop'].astype(str).astype('category')
+    return merged
+
+
+def load_cgap_df(decoded, progress=None):
+    """Return (dataset key, cgap_df) for the uploaded bytes, skipping the Excel parse on a cache hit.
+
+    progress, if given, is called with the name of each stage as it starts:
+    'read', 'normalize', 'crop grouping' and finally 'ready'.
+    """
+    report = progress or (lambda stage: None)
+    rules = load_crop_rules()
+    # A change of the crop rules must not serve frames normalized with the old ones
+    key = cgap_cache.content_key(decoded, crop_rules_fingerprint(rules))
+    with cgap_metrics.span('cache read') as span:
+        cgap_df = cgap_cache.get(key)
+        span['rows'] = 0 if cgap_df is None else len(cgap_df)
+    if cgap_df is None:
+        report('read')
+        with cgap_metrics.span('excel parse') as span:
+            df = read_master_gap(decoded)
+            span.update(rows=len(df), bytes=len(decoded))
+        report('normalize')
+        with cgap_metrics.span('column resolution') as span:
+            cgap_df = select_cgap_columns(df)
+            span['rows'] = len(cgap_df)
+        report('crop grouping')
+        with cgap_metrics.span('crop normalization') as span:
+            cgap_df = group_crops(cgap_df, rules)
+            span['rows'] = len(cgap_df)
+        with cgap_metrics.span('cache write'):
+            cgap_cache.put(key, cgap_df)
+    report('ready')
+    return key, cgap_df
@@ -0,0 +1,155 @@
+# Pre-flight check of an uploaded workbook, run in the web process before any parse is queued.
+# Only the ZIP directory, xl/workbook.xml (+ its relationships), the start of the MasterGAP sheet
+# XML and the shared strings its header rows use are read, so a wrong file, a missing sheet or
+# missing columns are reported in milliseconds instead of after a full openpyxl parse.
+import posixpath
+import re
+import zipfile
+import zlib
+from io import BytesIO
+from xml.etree import ElementTree
+
+import cgap_schema
+
+
+SHEET_NAME = 'MasterGAP'
+# Columns the critical-GAP ranking cannot do without; at least one zone and one rate column are needed too
+REQUIRED_COLUMNS = ['Product(PLT short)',
+                    'Crop',
+                    'Max # of applns.(per block)',
+                    'Application timing BBCH end',
+                    'PHI',
+                    'Minimum appl. interval(days)']
+
+_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+_OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+_CELL_REF = re.compile(r'([A-Z]+)(\d+)')
+# Raised while reading a damaged archive: bad XML, corrupt deflate data, truncated entries,
+# unsupported compression (NotImplementedError) or encrypted entries (RuntimeError)
+_DAMAGED = (ElementTree.ParseError, zipfile.BadZipFile, zlib.error, RuntimeError, EOFError)
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _sheet_part(archive):
+    """Return the path of the MasterGAP worksheet inside the archive."""
+    try:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    except KeyError as e:
+        raise ValueError('not an Excel workbook: %s' % e.args[0])
+    except _DAMAGED as e:
+        raise ValueError('the workbook file is damaged (%s)' % e)
+    sheets = {sheet.get('name'): sheet.get(_RELATIONSHIP_ID) for sheet in workbook.iter(_MAIN + 'sheet')}
+    if SHEET_NAME not in sheets:
+        raise ValueError("no '%s' sheet in the workbook (sheets: %s)" % (SHEET_NAME, ', '.join(sheets) or 'none'))
+    target = next((rel.get('Target') for rel in relationships if rel.get('Id') == sheets[SHEET_NAME]), None)
+    if target is None:
+        raise ValueError("the '%s' sheet is missing from the workbook file" % SHEET_NAME)
+    # Targets are relative to xl/, or absolute within the package
+    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+
+
+def _head_rows(archive, part, n_rows):
+    """Return (last row of the sheet dimension or None, first n_rows rows as lists of raw cells).
+
+    Cells are (type, value) pairs; shared strings are left as their index.
+    """
+    last_row = None
+    rows = [[] for _ in range(n_rows)]
+    row_number = 0
+    with archive.open(part) as source:
+        for _, element in ElementTree.iterparse(source):
+            if element.tag == _MAIN + 'dimension':
+                match = _CELL_REF.findall(element.get('ref', ''))
+                last_row = int(match[-1][1]) if match else None
+            elif element.tag == _MAIN + 'row':
+                # The r attributes are optional: without them rows and cells follow each other
+                row_number = int(element.get('r', row_number + 1))
+                if row_number > n_rows:
+                    break
+                row = rows[row_number - 1]
+                for cell in element.iter(_MAIN + 'c'):
+                    match = _CELL_REF.match(cell.get('r', ''))
+                    position = len(row) if match is None else _column_index(match.group(1))
+                    value = cell.findtext(_MAIN + 'v')
+                    if cell.get('t') == 'inlineStr':
+                        value = ''.join(text.text or '' for text in cell.iter(_MAIN + 't'))
+                    row.extend([None] * (position + 1 - len(row)))
+                    row[position] = (cell.get('t'), value)
+                element.clear()
+            elif element.tag == _MAIN + 'sheetData':
+                break
+    return last_row, rows
+
+
+def _shared_strings(archive, wanted):
+    """Return {index: text} of the wanted shared string indexes, reading no further than needed."""
+    strings = {}
+    if not wanted:
+        return strings
+    last = max(wanted)
+    try:
+        source = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return strings
+    with source:
+        index = 0
+        for _, element in ElementTree.iterparse(source):
+            if element.tag != _MAIN + 'si':
+                continue
+            if index in wanted:
+                # Rich text is split in runs; phonetic hints (rPh) are not part of the text
+                runs = [run for run in element if run.tag != _MAIN + 'rPh']
+                strings[index] = ''.join(text.text or '' for run in runs for text in run.iter(_MAIN + 't'))
+            element.clear()
+            index += 1
+            if index > last:
+                break
+    return strings
+
+
+def check_workbook(decoded):
+    """Check that decoded is an xlsx/xlsm workbook with a usable MasterGAP sheet.
+
+    Raises ValueError with the reason otherwise; returns {'header_row', 'last_row', 'columns'}.
+    """
+    if decoded[:len(_OLE_SIGNATURE)] == _OLE_SIGNATURE:
+        raise ValueError('this is an old .xls (or encrypted) workbook: save it as .xlsx or .xlsm')
+    try:
+        archive = zipfile.ZipFile(BytesIO(decoded))
+    except zipfile.BadZipFile:
+        raise ValueError('not an Excel workbook (.xlsx / .xlsm)')
+    with archive:
+        part = _sheet_part(archive)
+        try:
+            last_row, raw_rows = _head_rows(archive, part, cgap_schema.SCAN_ROWS)
+            wanted = {int(cell[1]) for row in raw_rows for cell in row
+                      if cell is not None and cell[0] == 's' and cell[1] is not None}
+            strings = _shared_strings(archive, wanted)
+        except KeyError as e:
+            raise ValueError('the workbook file is incomplete (%s)' % e)
+        except _DAMAGED + (ValueError,) as e:
+            raise ValueError('the workbook file is damaged (%s)' % e)
+
+    rows = [tuple(None if cell is None else strings.get(int(cell[1])) if cell[0] == 's' else cell[1] for cell in row)
+            for row in raw_rows]
+    header_row, columns = cgap_schema.resolve(rows)
+    names = set(columns.values())
+    missing = [name for name in REQUIRED_COLUMNS if name not in names]
+    if not names & set(cgap_schema.ZONE_COLUMNS):
+        missing.append(' or '.join(cgap_schema.ZONE_COLUMNS))
+    if not any(cgap_schema.is_rate_column(name) for name in names):
+        missing.append('Application rate <active substance> (g/ha)')
+    if missing:
+        raise ValueError("the '%s' sheet is missing the column(s) %s (header found on row %d)"
+                         % (SHEET_NAME, '; '.join(missing), header_row))
+    if last_row is not None and last_row <= header_row:
+        raise ValueError("the '%s' sheet has no GAP rows below its header row (%d)" % (SHEET_NAME, header_row))
+    return {'header_row': header_row, 'last_row': last_row, 'columns': list(columns.values())}
@@ -0,0 +1,153 @@
+# Header-row and column detection of the MasterGAP sheet. The column titles sit on row 7 of the
+# current template, but copies of older templates put them elsewhere and hand-edited ones
+# misspell them ('applicationn timing BBCH end'). Only the first SCAN_ROWS rows are scanned for
+# the header row; its titles are matched to the canonical cGAP column names ignoring case and
+# whitespace, with a fuzzy fallback for typos. The result is cached per template fingerprint
+# (header row position and titles), so later uploads of the same template skip the detection.
+import difflib
+import hashlib
+import json
+import os
+import re
+
+import cgap_cache
+
+
+ZONE_COLUMNS = ['Regulatory Zone', 'Residues region']
+# Canonical names, in the column order of cgap_df; the rate columns follow
+CANONICAL_COLUMNS = ['Product(PLT short)',
+                     'Crop',
+                     'Application timing BBCH end',
+                     'PHI',
+                     'Max # of applns.(per block)',
+                     'Minimum appl. interval(days)',
+                     'Maximum appl. interval(days)'] + ZONE_COLUMNS
+# Rows searched for the header row
+SCAN_ROWS = int(os.environ.get('CGAP_HEADER_SCAN_ROWS', '20'))
+# Smallest similarity (difflib ratio) for a misspelled title to stand for a canonical name
+FUZZY_CUTOFF = 0.9
+
+_RATE_TITLE = re.compile(r'\s*application\s*rate\s*(.*?)\s*\(g/ha\)\s*$', re.IGNORECASE | re.DOTALL)
+_schemas = {}
+
+
+def is_rate_column(col):
+    return col.startswith("Application rate") and col.endswith("(g/ha)")
+
+
+def _normalized(title):
+    return re.sub(r'\s+', '', str(title)).lower()
+
+
+def _rate_name(title):
+    """Canonical name of an 'Application rate <AS> (g/ha)' title, or None."""
+    match = _RATE_TITLE.match(str(title))
+    if match is None or not match.group(1):
+        return None
+    return 'Application rate %s (g/ha)' % ' '.join(match.group(1).split())
+
+
+def map_columns(titles):
+    """Return {position: canonical name} of the cGAP columns among titles, in cgap_df column order.
+
+    Exact matches (ignoring case and whitespace) are taken first, so a typo never claims the
+    column of a correctly spelled title; duplicate titles keep their first occurrence.
+    """
+    normalized = [None if title is None else _normalized(title) for title in titles]
+    found = {}
+    for name in CANONICAL_COLUMNS:
+        target = _normalized(name)
+        position = next((i for i, title in enumerate(normalized) if title == target), None)
+        if position is not None and position not in found.values():
+            found[name] = position
+    for name in CANONICAL_COLUMNS:
+        if name in found:
+            continue
+        matcher = difflib.SequenceMatcher(b=_normalized(name))
+        best, best_ratio = None, FUZZY_CUTOFF
+        for i, title in enumerate(normalized):
+            if title is None or i in found.values():
+                continue
+            matcher.set_seq1(title)
+            if matcher.real_quick_ratio() >= best_ratio and matcher.quick_ratio() >= best_ratio:
+                ratio = matcher.ratio()
+                if ratio >= best_ratio and (best is None or ratio > best_ratio):
+                    best, best_ratio = i, ratio
+        if best is not None:
+            found[name] = best
+
+    columns = {found[name]: name for name in CANONICAL_COLUMNS if name in found}
+    rates = set()
+    for i, title in enumerate(titles):
+        name = None if title is None or i in columns else _rate_name(title)
+        if name is not None and name not in rates:
+            columns[i] = name
+            rates.add(name)
+    return columns
+
+
+def _score(titles):
+    """Number of titles that exactly name a cGAP column; cheap enough to run on every scanned row."""
+    targets = {_normalized(name) for name in CANONICAL_COLUMNS}
+    return sum(1 for title in titles
+               if title is not None and (_normalized(title) in targets or _rate_name(title) is not None))
+
+
+def detect(rows):
+    """Return (1-based header row number, {position: canonical name}) from the first rows of a sheet."""
+    scores = [_score(titles) for titles in rows]
+    if not scores or max(scores) == 0:
+        raise ValueError('no header row with the cGAP columns in the first %d rows of the MasterGAP sheet'
+                         % len(scores))
+    header_row = scores.index(max(scores)) + 1
+    return header_row, map_columns(rows[header_row - 1])
+
+
+def fingerprint(row_number, titles):
+    """Template fingerprint: position and titles of the header row."""
+    titles = [None if title is None else str(title) for title in titles]
+    # Sheets of the same template may differ in width: trailing empty cells do not count
+    while titles and titles[-1] is None:
+        titles.pop()
+    content = json.dumps([cgap_cache.CACHE_VERSION, row_number] + titles)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+
+def _path(key):
+    return os.path.join(cgap_cache.CACHE_DIR, 'schema-%s.json' % key)
+
+
+def _load(key):
+    if key in _schemas:
+        return _schemas[key]
+    try:
+        with open(_path(key)) as f:
+            columns = {position: name for position, name in json.load(f)}
+    except (OSError, ValueError):
+        return None
+    _schemas[key] = columns
+    return columns
+
+
+def _save(key, columns):
+    _schemas[key] = columns
+    try:
+        os.makedirs(cgap_cache.CACHE_DIR, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (_path(key), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(list(columns.items()), f)
+        os.replace(tmp_path, _path(key))
+    except OSError:
+        pass
+
+
+def resolve(rows):
+    """Like detect, but served from the schema cache when a scanned row is a known header row."""
+    rows = [tuple(titles) for titles in rows[:SCAN_ROWS]]
+    for row_number, titles in enumerate(rows, start=1):
+        columns = _load(fingerprint(row_number, titles))
+        if columns is not None:
+            return row_number, columns
+    header_row, columns = detect(rows)
+    _save(fingerprint(header_row, rows[header_row - 1]), columns)
+    return header_row, columns
@@ -0,0 +1,80 @@
+# Session-scoped store for the frames each analyst works on (cgap_df, critical_values, ...).
+# Replaces the module-level globals so concurrent users never see each other's uploads.
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def frame_bytes(frame):
+    try:
+        return int(frame.memory_usage(index=True, deep=True).sum())
+    except AttributeError:
+        return 0
+
+
+class SessionStore:
+    """In-process store of named frames per session, bounded by a memory cap.
+
+    Sessions are kept in least-recently-used order: when the total size goes over
+    max_bytes, or a session has been idle longer than idle_seconds, the stalest
+    sessions are dropped first.
+    """
+
+    def __init__(self, max_bytes=None, idle_seconds=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('CGAP_SESSION_MAX_MB', '1024')) * 1024 * 1024)
+        if idle_seconds is None:
+            idle_seconds = float(os.environ.get('CGAP_SESSION_IDLE_SECONDS', '3600'))
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+    def get(self, session_id, name, default=None):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or name not in session['frames']:
+                return default
+            session['last_seen'] = time.time()
+            self._sessions.move_to_end(session_id)
+            return session['frames'][name]
+
+    def put(self, session_id, name, frame):
+        with self._lock:
+            session = self._sessions.setdefault(session_id, {'frames': {}, 'sizes': {}, 'last_seen': 0})
+            self.total_bytes -= session['sizes'].get(name, 0)
+            size = frame_bytes(frame)
+            session['frames'][name] = frame
+            session['sizes'][name] = size
+            session['last_seen'] = time.time()
+            self.total_bytes += size
+            self._sessions.move_to_end(session_id)
+            self._evict(keep=session_id)
+
+    def drop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.total_bytes -= sum(session['sizes'].values())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, keep):
+        now = time.time()
+        for session_id in list(self._sessions):
+            if session_id == keep:
+                continue
+            session = self._sessions[session_id]
+            if self.total_bytes <= self.max_bytes and now - session['last_seen'] <= self.idle_seconds:
+                # Sessions are in LRU order: everything after this one is fresher
+                break
+            del self._sessions[session_id]
+            self.total_bytes -= sum(session['sizes'].values())
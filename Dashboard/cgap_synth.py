@@ -0,0 +1,128 @@
+# Synthetic Master GAP tables for benchmarking: MasterGAP-shaped frames and workbooks with
+# realistic product, crop and zone cardinalities.
+#
+#   python Dashboard/cgap_synth.py 100000 synthetic_master_gap.xlsx
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+from cgap_pipeline import HEADER_ROW, STOP_MARKER
+
+
+# Excel sheets stop at 1,048,576 rows; larger tables only exist as frames
+EXCEL_MAX_ROWS = 1048576 - HEADER_ROW - 1
+
+ACTIVES = ['PTZ', 'SPX', 'TFS', 'BIX', 'FLU', 'PQA', 'FXA']
+PRODUCTS = [
+    ('BIX+FLU+PTZ EC 260 (65+65+130 g/L)', ['BIX', 'FLU', 'PTZ']),
+    ('BIX+FXA+PTZ EC 190 (40+50+100 g/L)', ['BIX', 'FXA', 'PTZ']),
+    ('BIX+PTZ EC 225 (75+150 g/L)', ['BIX', 'PTZ']),
+    ('BIX+PTZ EC 260 (60+200 g/L)', ['BIX', 'PTZ']),
+    ('BIX+PTZ+SPX EC 400 (50+100+250 g/L)', ['BIX', 'PTZ', 'SPX']),
+    ('FLU+PTZ SE 250 (125+125 g/L)', ['FLU', 'PTZ']),
+    ('FXA+PTZ EC 150 (50+100 g/L)', ['FXA', 'PTZ']),
+    ('FXA+PTZ EC 150 (50+100 g/L) neo', ['FXA', 'PTZ']),
+    ('FXA+PTZ EC 200 (100+100 g/L)', ['FXA', 'PTZ']),
+    ('PQA+PTZ+SPX EC 400 (40+160+200 g/L)', ['PQA', 'PTZ', 'SPX']),
+    ('Prothioconazole SC 480 (480 g/L)', ['PTZ']),
+    ('PTZ+SPX EC 460 (160+300 g/L)', ['PTZ', 'SPX']),
+    ('PTZ+SPX+TFS EC 280.3 (93.3+107+80 g/L)', ['PTZ', 'SPX', 'TFS']),
+    ('PTZ+TFS SC 263 (175+88 g/L)', ['PTZ', 'TFS']),
+    ('PTZ+TFS SC 325 (175+150 g/L)', ['PTZ', 'TFS']),
+    ('PTZ EC 250 (250 g/L)', ['PTZ']),
+]
+CROPS = ['Barley, spring', 'Barley, winter', 'Wheat, durum', 'Wheat, spring', 'Wheat, winter',
+         'Rye, winter', 'Triticale, winter', 'Spelt', 'Oat, spring', 'Rape, spring', 'Rape, winter',
+         'Cabbage, head', 'Cabbage, red', 'Onion', 'Onion, spring', 'Bean, field', 'Beet, red (beetroot)',
+         'Broccoli', 'Brussels sprouts', 'Carrot', 'Cauliflower', 'Chicory, roots', 'Corn / Maize',
+         'Corn, sweet', 'Flax / Linseed', 'Garlic', 'Grass (seed production)', 'Grassland', 'Horseradish',
+         'Leek', 'Mustard crops', 'Parsnip', 'Peas, field', 'Poppy, seed', 'Potato', 'Potatoes (seed)',
+         'Pumpkin', 'Shallot', 'Soybean', 'Sugarbeet', 'Sunflower', 'Swedes', 'Turnip', 'Turnip rape']
+REGULATORY_ZONES = ['Central', 'Northern', 'Southern']
+RESIDUES_REGIONS = ['North EU', 'South EU', 'North&South EU']
+MEMBER_STATES = ['AUT', 'BEL', 'CZE', 'DEU', 'DNK', 'ESP', 'EST', 'FIN', 'FRA', 'GBR', 'GRC', 'HUN', 'IRL',
+                 'ITA', 'LTU', 'LVA', 'NLD', 'POL', 'PRT', 'ROU', 'SVK', 'SVN', 'SWE']
+
+
+def make_master_gap_frame(n_rows, seed=0):
+    """Return a raw MasterGAP frame of n_rows GAPs, with the sheet's column titles.
+
+    Next to the columns the pipeline uses, the frame carries a share of the sheet's other
+    columns so that the column projection has something to skip.
+    """
+    rng = np.random.default_rng(seed)
+    product_codes = rng.integers(0, len(PRODUCTS), n_rows)
+    bbch_start = rng.integers(10, 60, n_rows)
+    n_applications = rng.integers(1, 4, n_rows)
+    min_interval = rng.choice([7, 10, 14, 21], n_rows).astype(float)
+    phi = rng.choice([-1, 28, 35, 42, 56], n_rows).astype(float)
+    phi[rng.random(n_rows) < 0.02] = np.nan
+
+    frame = {
+        'Formatting help': np.zeros(n_rows, dtype=np.int64),
+        'Internal ID': np.char.add('10200002', np.arange(n_rows).astype(str)),
+        'Project status': np.full(n_rows, 'Under evaluation', dtype=object),
+        'GAP supported': rng.choice(['yes', 'no'], n_rows, p=[0.9, 0.1]),
+        'Include in B-0?': rng.choice(['yes', 'no'], n_rows),
+        'Expert scenario?': rng.choice(['yes', 'no'], n_rows),
+        'Regulatory Zone': rng.choice(REGULATORY_ZONES, n_rows),
+        'EPPO zone': rng.choice(['Maritime', 'North-East', 'South-East', 'Mediterranean'], n_rows),
+        'Residues region': rng.choice(RESIDUES_REGIONS, n_rows),
+        'Product\n(PLT short)': np.array([name for name, _ in PRODUCTS], dtype=object)[product_codes],
+        'Product (SpecNo)': 102000027828 + product_codes,
+        'Use ID': rng.integers(1, 200, n_rows),
+        'Member state code': rng.choice(MEMBER_STATES, n_rows),
+        'Crop': rng.choice(CROPS, n_rows),
+        'Crop (EPPO code)': rng.choice(['HORVS', 'TRZAW', 'BRSNW', 'ALLCE'], n_rows),
+        'Minor use': rng.choice(['yes', 'no'], n_rows, p=[0.2, 0.8]),
+        'Use type (F/G/I)': rng.choice(['F', 'G'], n_rows, p=[0.95, 0.05]),
+        'applicationn method': rng.choice(['spraying', 'seed treatment'], n_rows, p=[0.9, 0.1]),
+        'applicationn timing \nBBCH start': bbch_start,
+        'applicationn timing BBCH end': bbch_start + rng.integers(0, 30, n_rows),
+        'applicationn timing BBCH range': np.full(n_rows, '-', dtype=object),
+        'PHI': phi,
+        'Max # of applns.\n(per block)': n_applications,
+        'Minimum appl. interval\n(days)': min_interval,
+        'Maximum appl. interval\n(days)': min_interval + rng.choice([0, 7, 14], n_rows),
+        'Remarks': np.full(n_rows, None, dtype=object),
+    }
+    # Actives absent from the product read '-' in the sheet, which makes these columns mixed-type
+    for active in ACTIVES:
+        in_product = np.array([active in actives for _, actives in PRODUCTS])[product_codes]
+        rates = rng.choice([25.0, 50.0, 65.0, 75.0, 100.0, 125.0, 150.0, 200.0], n_rows)
+        column = rates.astype(object)
+        column[~in_product] = '-'
+        frame['Application rate %s (g/ha)' % active] = column
+    return pd.DataFrame(frame)
+
+
+def write_master_gap_workbook(frame, path_or_buffer=None, constant_memory=False):
+    """Write frame as a MasterGAP sheet: 6 template rows, the titles on row 7, the GAPs and the 'STOP' row.
+
+    Returns the workbook bytes when no path is given. By default strings go to the shared
+    string table like in workbooks saved by Excel; constant_memory=True bounds the writer's
+    memory for very large sheets but stores inline strings, which openpyxl reads much slower.
+    """
+    import xlsxwriter
+
+    if len(frame) > EXCEL_MAX_ROWS:
+        raise ValueError('%d rows do not fit in an Excel sheet (max %d)' % (len(frame), EXCEL_MAX_ROWS))
+    output = io.BytesIO() if path_or_buffer is None else path_or_buffer
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': constant_memory})
+    worksheet = workbook.add_worksheet('MasterGAP')
+    worksheet.write_row(0, 2, ['Master GAP list (synthetic)'])
+    worksheet.write_row(HEADER_ROW - 1, 0, list(frame.columns))
+    for row_number, row in enumerate(frame.itertuples(index=False, name=None), start=HEADER_ROW):
+        worksheet.write_row(row_number, 0, [None if pd.isna(value) else value for value in row])
+    worksheet.write_row(HEADER_ROW + len(frame), 0, [STOP_MARKER] * len(frame.columns))
+    workbook.close()
+    if path_or_buffer is None:
+        return output.getvalue()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python cgap_synth.py N_ROWS OUTPUT.xlsx')
+    write_master_gap_workbook(make_master_gap_frame(int(sys.argv[1])), sys.argv[2])
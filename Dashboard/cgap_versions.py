@@ -0,0 +1,77 @@
+# Versioned datasets: diff a new upload of a Master GAP table against the previous version by
+# row content, so that only the (zone, product, crop, applications) groups touched by the
+# revision are ranked again, and report which critical GAPs changed.
+import os
+
+import numpy as np
+import pandas as pd
+
+
+INCREMENTAL = os.environ.get('CGAP_INCREMENTAL', '1') != '0'
+# Above this share of changed rows the upload is treated as a new dataset, not a revision
+MAX_CHANGED_SHARE = float(os.environ.get('CGAP_MAX_CHANGED_SHARE', '0.5'))
+# Change report rows shown in the app
+REPORT_ROWS = 200
+
+
+def row_hashes(cgap_df):
+    """64-bit content hash of every row; the same GAP hashes the same in both versions."""
+    return pd.util.hash_pandas_object(cgap_df, index=False).to_numpy()
+
+
+def diff_rows(previous_df, cgap_df):
+    """Return (positions of rows removed from previous_df, positions of rows added in cgap_df).
+
+    A revised row shows up as one removal and one addition.
+    """
+    if list(previous_df.columns) != list(cgap_df.columns):
+        return np.arange(len(previous_df)), np.arange(len(cgap_df))
+    previous, current = row_hashes(previous_df), row_hashes(cgap_df)
+    return np.flatnonzero(~np.isin(previous, current)), np.flatnonzero(~np.isin(current, previous))
+
+
+def is_revision(previous_df, cgap_df, removed, added):
+    changed = len(removed) + len(added)
+    return changed <= MAX_CHANGED_SHARE * max(1, len(previous_df) + len(cgap_df))
+
+
+def affected_groups(previous_df, removed, cgap_df, added, keys):
+    """MultiIndex of the group keys that gained or lost rows."""
+    changed = pd.concat([previous_df.iloc[removed][keys], cgap_df.iloc[added][keys]], ignore_index=True)
+    return pd.MultiIndex.from_frame(changed.astype(object)).unique()
+
+
+def in_groups(frame, keys, groups):
+    """Boolean mask of the frame rows whose group key is in groups."""
+    return pd.MultiIndex.from_frame(frame[keys].astype(object)).isin(groups)
+
+
+def merge_critical_values(previous_critical, recomputed, groups, keys, cgap_df):
+    """Replace the critical values of the affected groups by their recomputed ones."""
+    kept = previous_critical[~in_groups(previous_critical, keys, groups)]
+    critical_values = pd.concat([kept, recomputed], ignore_index=True)
+    for col in keys:
+        # Categories of the new version (e.g. a crop added by the revision)
+        if isinstance(cgap_df[col].dtype, pd.CategoricalDtype):
+            critical_values[col] = critical_values[col].astype(cgap_df[col].dtype)
+    try:
+        return critical_values.sort_values(keys, kind='mergesort').reset_index(drop=True)
+    except TypeError:
+        return critical_values
+
+
+def change_report(previous_critical, critical_values, groups, keys, rate_column):
+    """Critical GAPs of the affected groups that were added, removed or replaced by another row."""
+    before = previous_critical[in_groups(previous_critical, keys, groups)]
+    after = critical_values[in_groups(critical_values, keys, groups)]
+    merged = before.astype({col: object for col in keys}).merge(
+        after.astype({col: object for col in keys}), on=keys, how='outer', suffixes=(' (previous)', ''), indicator=True)
+    compared = [col for col in after.columns if col not in keys]
+    differs = np.zeros(len(merged), dtype=bool)
+    for col in compared:
+        differs |= merged[col + ' (previous)'].astype(str).to_numpy() != merged[col].astype(str).to_numpy()
+    merged['Change'] = np.select([merged['_merge'] == 'left_only', merged['_merge'] == 'right_only'],
+                                 ['removed', 'added'], 'changed')
+    report = merged[(merged['_merge'] != 'both') | differs]
+    return report[['Change'] + keys + [rate_column + ' (previous)', rate_column]
+                  + [col for col in compared if col != rate_column]].reset_index(drop=True)
@@ -0,0 +1,44 @@
+# Compact columnar payload for the tables sent to the browser (critical-store, server pages).
+# Every column is dictionary-encoded: its distinct values are listed once and the rows carry
+# base64-packed unsigned codes into that list (code 0 is null). Product names, crops, zones and
+# the few distinct rates / BBCH / PHI values are therefore not repeated on every row.
+# assets/cgap_table.js decodes the payload back into DataTable records.
+import base64
+
+import numpy as np
+import pandas as pd
+
+
+# Smallest little-endian code type that fits the dictionary
+CODE_TYPES = ['u1', 'u2', 'u4']
+
+
+def _json_values(uniques):
+    values = np.asarray(uniques, dtype=object)
+    return [None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value
+            for value in values]
+
+
+def encode_frame(frame):
+    """Return the columnar, dictionary-encoded payload of frame."""
+    dictionaries, codes, types = [], [], []
+    for col in frame.columns:
+        column_codes, uniques = pd.factorize(frame[col])
+        dictionaries.append([None] + _json_values(uniques))
+        # Shift so that missing values (-1) become code 0
+        column_codes = column_codes + 1
+        code_type = next(name for name in CODE_TYPES if len(uniques) <= np.iinfo(name).max)
+        codes.append(base64.b64encode(column_codes.astype('<' + code_type).tobytes()).decode('ascii'))
+        types.append(code_type)
+    return {'length': len(frame), 'columns': [str(col) for col in frame.columns],
+            'dictionaries': dictionaries, 'codes': codes, 'types': types}
+
+
+def decode_frame(payload):
+    """Inverse of encode_frame, as done in the browser."""
+    columns = {}
+    for col, dictionary, packed, code_type in zip(payload['columns'], payload['dictionaries'],
+                                                  payload['codes'], payload['types']):
+        column_codes = np.frombuffer(base64.b64decode(packed), dtype='<' + code_type)
+        columns[col] = np.asarray(dictionary, dtype=object)[column_codes]
+    return pd.DataFrame(columns, columns=payload['columns'], index=pd.RangeIndex(payload['length']))
@@ -1,460 +1,583 @@
 # Import required libraries
-import pandas as pd
+import functools
+
 import dash
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
-import base64
-from io import BytesIO
 import dash_bootstrap_components as dbc
-import urllib.parse
 from dash.exceptions import PreventUpdate
 import os
-import openpyxl 
-import io
 
-# Initialize the Dash app
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+from cgap_pipeline import decode_upload, rate_columns_of, region_columns_of
+import cgap_aggregate
+import cgap_cache
+import cgap_jobs
+import cgap_metrics
+import cgap_versions
+from cgap_wire import encode_frame
+from cgap_export import EXPORT_FORMATS, cached_artifact, selection_key, write_export
+from cgap_filter import apply_filter_query, apply_sort, page
+from cgap_store import SessionStore, new_session_id
+
+# Critical tables up to this many rows are sent to the browser once and filtered there
+CLIENTSIDE_MAX_ROWS = int(os.environ.get('CGAP_CLIENTSIDE_MAX_ROWS', '20000'))
+# The workbook parser and the export libraries are imported on first use; CGAP_FAST_START=0
+# imports them at startup instead, e.g. to share them between the workers of gunicorn --preload
+FAST_START = os.environ.get('CGAP_FAST_START', '1') != '0'
+# Browser cache lifetime of the files in assets/ (the logo), in seconds
+STATIC_MAX_AGE = int(os.environ.get('CGAP_STATIC_MAX_AGE', '86400'))
+
 # Define the layout of the app
 
-# Load the image
-image_filename =  os.path.join(os.path.dirname(__file__),'Logo.png')  # Path to your image file
-encoded_image = base64.b64encode(open(image_filename, 'rb').read()).decode('ascii')
-app.layout = dbc.Container(
-    fluid=True,
-    style={'backgroundColor': '#80c3d8'},
-    children=[
-        dbc.Row(
-            dbc.Col(
-                html.Img(src=f'data:image/png;base64,{encoded_image}',
-                          style={'height': '250px', 'margin': 'auto', 'display': 'block'}), 
-                width=12
+
+# The layout is served by a function so every page load gets its own session id. The logo is
+# a static file (assets/Logo.png) the browser caches, not a base64 string in every layout.
+def serve_layout(logo_url='/assets/Logo.png'):
+    return dbc.Container(
+        fluid=True,
+        style={'backgroundColor': '#80c3d8'},
+        children=[
+            dbc.Row(
+                dbc.Col(
+                    html.Img(src=logo_url,
+                              style={'height': '250px', 'margin': 'auto', 'display': 'block'}), 
+                    width=12
+                ),
             ),
-        ),
-        #dbc.Row(
-        #    dbc.Col(html.H1('c.GAP identifier', className='text-center mb-4'), width=10)
-        #),
-        dbc.Row(
-            dbc.Col(
-                dbc.Card(
-                    dbc.CardBody([
-                        dcc.Markdown('''
-                          This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory
-                           managers,in which there are each of the requested GAPs by country, crop and product. 
+            #dbc.Row(
+            #    dbc.Col(html.H1('c.GAP identifier', className='text-center mb-4'), width=10)
+            #),
+            dbc.Row(
+                dbc.Col(
+                    dbc.Card(
+                        dbc.CardBody([
+                            dcc.Markdown('''
+                              This app takes as input the excel file "*Master GAP Table with revised GAPs*" provided by the regional regulatory
+                               managers,in which there are each of the requested GAPs by country, crop and product. 
                                      
                              
                                      
-                             As for crops we discarded rye, triticale, spelt, oat and we group together the some crops eg: Barley (spring & winter) and  
-                              wheat (durum, spring, winter), Cabbage, Onion, Rape.
+                                 As for crops we discarded rye, triticale, spelt, oat and we group together the some crops eg: Barley (spring & winter) and  
+                                  wheat (durum, spring, winter), Cabbage, Onion, Rape.
                              
                                      
-                            This app identifies among all these GAPs, the most critical GAP by formulation (J-neck) / by regulatory zone (G-collar)
-                            / by crop (O-collar).
-                                     Here are the 5 criteria used to define the most critical GAP:
+                                This app identifies among all these GAPs, the most critical GAP by formulation (J-neck) / by regulatory zone (G-collar)
+                                / by crop (O-collar).
+                                         Here are the 5 criteria used to define the most critical GAP:
                                      
-                                        - 1 - Application rate  (g/ha), higher is the most critical        
-                                        - 2 - BBCH stage the latest, max is the most critical
-                                        - 3 - The shortest PHI (PHI): smaller  is the most critical
-                                        - 4 - Interval between applications: the smallest interval is the most critical     
-                                        - 5 - Nb of application: the higher Application rate x Nb of application is the most critical
-                                                                ''') ,
-                    ]),
-                    className="mb-3",
-                    style={'backgroundColor': '#b1dae7'} 
-                ),
-                #width={'size': 8, 'offset': 3}  # Center the card on the page
-            )
-        ),
+                                            - 1 - Application rate  (g/ha), higher is the most critical        
+                                            - 2 - BBCH stage the latest, max is the most critical
+                                            - 3 - The shortest PHI (PHI): smaller  is the most critical
+                                            - 4 - Interval between applications: the smallest interval is the most critical     
+                                            - 5 - Nb of application: the higher Application rate x Nb of application is the most critical
+                                                                    ''') ,
+                        ]),
+                        className="mb-3",
+                        style={'backgroundColor': '#b1dae7'} 
+                    ),
+                    #width={'size': 8, 'offset': 3}  # Center the card on the page
+                )
+            ),
 
 
-        dbc.Row(
-            dbc.Col(
-                dcc.Upload(
-                    id='upload-data',
-                    children=html.Div([
-                        'Drag and Drop or ',
-                        html.A('Select Files')
-                    ]),
-                    style={
-                        'width': '100%',
-                        'height': '60px',
-                        'lineHeight': '60px',
-                        'borderWidth': '1px',
-                        'borderStyle': 'dashed',
-                        'borderRadius': '5px',
-                        'textAlign': 'center'
-                    },
-                    multiple=False
-                ),
-                width=12
-            )
-        ),
-              
             dbc.Row(
                 dbc.Col(
-                    html.Div(id='msg_table', style={'marginTop': '30px'}),
-                    #width={'size': 8, 'offset': 3}
+                    dcc.Upload(
+                        id='upload-data',
+                        children=html.Div([
+                            'Drag and Drop or ',
+                            html.A('Select Files')
+                        ]),
+                        style={
+                            'width': '100%',
+                            'height': '60px',
+                            'lineHeight': '60px',
+                            'borderWidth': '1px',
+                            'borderStyle': 'dashed',
+                            'borderRadius': '5px',
+                            'textAlign': 'center'
+                        },
+                        # Several regional Master GAP tables can be uploaded together and are merged
+                        multiple=True
+                    ),
+                    width=12
                 )
             ),
+              
+                dbc.Row(
+                    dbc.Col(
+                        html.Div(id='msg_table', style={'marginTop': '30px'}),
+                        #width={'size': 8, 'offset': 3}
+                    )
+                ),
     
 
             
 
-            dbc.Row(
-            dbc.Col(
-                dcc.Loading(  # Add the Loading component here
-                    id="loading",
-                    type="default",  # You can choose 'default', 'circle', or 'square'
+                dbc.Row(
+                dbc.Col(
+                    dcc.Loading(  # Add the Loading component here
+                        id="loading",
+                        type="default",  # You can choose 'default', 'circle', or 'square'
                     
-                    children=[
+                        children=[
                         
-                        dcc.Dropdown(
-                            id='regulatory-filter',
-                            options=[],
-                            multi=False,
-                            placeholder='Select Regulatory Region for the GAP',
-                            style={'width': '500px', 'margin': '10px', 'color': '#000', 'background-color': '#fff', 'border': '1px solid #ccc'},
-                            className='dropdown-custom'
-                        ),
-                        dcc.Dropdown(
-                            id='ApplicationRate-filter',
-                            options=[],
-                            multi=False,
-                            placeholder='Select ApplicationRate for the GAP',
-                            style={'width': '500px', 'margin': '10px', 'color': '#000', 'background-color': '#fff', 'border': '1px solid #ccc'},
-                            className='dropdown-custom'
-                        ),
+                            dcc.Dropdown(
+                                id='regulatory-filter',
+                                options=[],
+                                multi=False,
+                                placeholder='Select Regulatory Region for the GAP',
+                                style={'width': '500px', 'margin': '10px', 'color': '#000', 'background-color': '#fff', 'border': '1px solid #ccc'},
+                                className='dropdown-custom'
+                            ),
+                            dcc.Dropdown(
+                                id='ApplicationRate-filter',
+                                options=[],
+                                multi=False,
+                                placeholder='Select ApplicationRate for the GAP',
+                                style={'width': '500px', 'margin': '10px', 'color': '#000', 'background-color': '#fff', 'border': '1px solid #ccc'},
+                                className='dropdown-custom'
+                            ),
                         
-                        dcc.Dropdown(
-                            id='product-filter',
-                            options=[],
-                            multi=True,
-                            placeholder='Select Product'
-                        ),
-
-                        dcc.Dropdown(
-                            id='crop-filter',
-                            options=[],
-                            multi=True,
-                            placeholder='Select crop'
-                        ),
+                            dcc.Dropdown(
+                                id='product-filter',
+                                options=[],
+                                multi=True,
+                                placeholder='Select Product'
+                            ),
+
+                            dcc.Dropdown(
+                                id='crop-filter',
+                                options=[],
+                                multi=True,
+                                placeholder='Select crop'
+                            ),
                         
-                        dcc.Dropdown(
-                            id='region-filter',
-                            options=[],
-                            multi=True,
-                            placeholder='Select region'
-                        ),
-                        html.Div(
-                            id='filtered-table',
-                            style={'marginTop': '30px'}
-                        ),
-
-
-
-                    ]
-                ),
-                # width={'size': 8, 'offset': 3}
-            )
-        ),
+                            dcc.Dropdown(
+                                id='region-filter',
+                                options=[],
+                                multi=True,
+                                placeholder='Select region'
+                            ),
+                            html.Div(
+                                id='filtered-table',
+                                style={'marginTop': '30px'}
+                            ),
+                            # Paged, sorted and filtered in the browser (assets/cgap_table.js) for tables
+                            # of up to CLIENTSIDE_MAX_ROWS rows, on the server for larger ones
+                            dash_table.DataTable(
+                                id='critical-table',
+                                columns=[],
+                                data=[],
+                                style_table={
+                                    'overflowX': 'scroll',
+                                    'overflowY': 'scroll',
+                                    'maxHeight': '100vh',
+                                    'height': '80%',
+                                    'minWidth': '100%'
+                                },
+                                style_cell={
+                                    'minWidth': '80px', 'maxWidth': '180px', 'whiteSpace': 'normal',
+                                    'fontSize': '10px'
+                                },
+                                style_header={
+                                    'backgroundColor':'#f9f9f9',
+                                    'whiteSpace': 'normal',
+                                    'height': 'auto',
+                                    'textAlign': 'center',
+                                    'maxWidth': '200px',
+                                    'fontSize': '12px'
+                                },
+                                page_action='custom',
+                                page_current=0,
+                                page_size=100,
+                                sort_action='custom',
+                                sort_mode='multi',
+                                sort_by=[],
+                                filter_action='custom',
+                                filter_query='',
+                                fixed_rows={'headers': True}
+                            ),
+
+
+
+                        ]
+                    ),
+                    # width={'size': 8, 'offset': 3}
+                )
+            ),
         
-            # Add the download button and link container
-            html.Div([
-                html.Div(id='download-link-container'),
-                dbc.Button('Export Data', id='download-button', color='primary', className='mt-3'),
-                dcc.Download(id='download-dataframe-csv')
+                # Add the download button; the file is sent through dcc.Download
+                html.Div([
+                    dcc.Dropdown(
+                        id='export-format',
+                        options=[{'label': label, 'value': fmt} for fmt, (label, extension) in EXPORT_FORMATS.items()],
+                        value='xlsx',
+                        clearable=False,
+                        style={'width': '300px', 'marginTop': '10px'}
+                    ),
+                    dbc.Button('Export Data', id='download-button', color='primary', className='mt-3'),
+                    dcc.Download(id='download-dataframe-csv')
                 
-            ])
+                ]),
+
+                # Small token pointing at the parsed dataset kept on the server, so filter
+                # callbacks never re-post the uploaded workbook
+                dcc.Store(id='dataset-token'),
+                # Background ingestion job of the last upload, polled until it is ready
+                dcc.Store(id='ingest-job'),
+                dcc.Interval(id='ingest-poll', interval=500, disabled=True),
+                dcc.Store(id='session-id', data=new_session_id()),
+                # Critical values of the selected zone / rate columns, or {'mode': 'server'} for large tables
+                dcc.Store(id='critical-store'),
+                # Server mode only: the table state sent to the server and the page it returns
+                dcc.Store(id='table-query'),
+                dcc.Store(id='server-page')
       
 
-    ]
-)
-
-# Callback to handle the loading state and apply blur effect
-@app.callback(
-    Output('loading', 'style'),
-    Input('loading', 'loading_state')
-)
-def update_loading_style(loading_state):
-    print('loading ...')
-    if loading_state and loading_state['is_loading']:
-        return {'filter': 'blur(2px)', 'transition': 'filter 0.3s ease'}  # Apply blur when loading
-    return {'filter': 'blur(0px)', 'transition': 'filter 0.3s ease'}  # No blur when not loading
-
-
-
-
-
-# Callback to handle the file upload and display the data
-@app.callback(
-    [Output('msg_table', 'children'),
-     Output('regulatory-filter', 'options'),
-     Output('ApplicationRate-filter', 'options')],
-    [Input('upload-data', 'contents')],
-    [State('upload-data', 'filename')]
-)
-
-def import_data(contents,filename):
-    print('---- am in function 1 ---- ')
-    global cgap_df 
+        ]
+    )
+
+
+# Parsed datasets held on the server per browser session; the token sent to the browser
+# names the dataset so an evicted session can be restored from the on-disk cache
+session_store = SessionStore()
+
+
+def get_dataset(session_id, dataset_token):
+    if dataset_token is None:
+        return None
+    if session_store.get(session_id, 'dataset_token') == dataset_token:
+        return session_store.get(session_id, 'cgap_df')
+    cgap_df = cgap_cache.get(dataset_token)
+    if cgap_df is not None:
+        session_store.put(session_id, 'cgap_df', cgap_df)
+        session_store.put(session_id, 'dataset_token', dataset_token)
+    return cgap_df
+
+
+def change_report_view(report):
+    """Summary and table of the critical GAPs that changed since the previous upload."""
+    if report is None:
+        return None
+    summary = 'Compared with the previous upload: %d critical GAPs differ' % len(report)
+    if report.empty:
+        return html.Div(summary, style={'color': 'grey'})
+    shown = report.head(cgap_versions.REPORT_ROWS)
+    return html.Details([
+        html.Summary(summary + ' (%s)' % ', '.join('%d %s' % (count, change) for change, count
+                                                   in report['Change'].value_counts().items())),
+        dash_table.DataTable(
+            data=shown.astype(object).where(shown.notna(), None).to_dict('records'),
+            columns=[{'name': col, 'id': col} for col in shown.columns],
+            style_table={'overflowX': 'scroll', 'maxHeight': '400px', 'overflowY': 'scroll'},
+            style_cell={'fontSize': '10px', 'whiteSpace': 'normal'},
+        ),
+    ], style={'color': 'grey'})
+
+
+def filtered_critical_values(dataset_token, cgap_df, region_columns, rate_columns,
+                             product_options, crop_options, region_options, filter_query=None, sort_by=None):
+    # Memoized per (dataset, zone column, rate column): filter changes reuse the grouped result
+    index = cgap_aggregate.filter_index(dataset_token, cgap_df, region_columns, rate_columns)
+    # Apply filtering based on product, crop and region filters, then the table's own filter and sort
+    with cgap_metrics.span('filtering') as span:
+        filtered_values = index.select({'Product(PLT short)': product_options,
+                                        'Crop': crop_options,
+                                        region_columns: region_options})
+        filtered_values = apply_filter_query(filtered_values, filter_query)
+        span['rows'] = len(filtered_values)
+    with cgap_metrics.span('sorting'):
+        return apply_sort(filtered_values, sort_by)
+
+
+def filter_options(cgap_df, region_columns):
+    """Crop, product and region dropdown options, each with the "All" option."""
+    if region_columns is None:
+        return [], [], []
+    crop_options = [{'label': 'All', 'value': 'All'}] + [{'label': crop, 'value': crop} for crop in cgap_df['Crop'].unique()]
+    product_options = [{'label': 'All', 'value': 'All'}] + [{'label': product, 'value': product} for product in cgap_df['Product(PLT short)'].dropna().unique()]
+    region_options = [{'label': 'All', 'value': 'All'}] + [{'label': region, 'value': region} for region in cgap_df[region_columns].unique()]
+    return crop_options, product_options, region_options
+
+
+def server_page(dataset_token, cgap_df, query):
+    """The page of the critical values asked for by a server-mode table query, echoing the query."""
+    filtered_values = filtered_critical_values(dataset_token, cgap_df, query['zone_column'], query['rate_column'],
+                                               query['product'], query['crop'], query['region'],
+                                               query['filter_query'], query['sort_by'])
+
+    # Only the visible page of the sorted and filtered table is serialized
+    page_values, page_count = page(filtered_values, query['page_current'], query['page_size'])
+    with cgap_metrics.span('page serialization') as span:
+        table = encode_frame(page_values)
+        span['rows'] = len(page_values)
+    cgap_metrics.annotate(rows=len(page_values))
+    return {'key': query['key'], 'query': query, 'table': table, 'page_count': page_count}
+
+
+def register_callbacks(app):
+    # Blur the loading area while it loads; purely presentational, so it runs in the browser
+    app.clientside_callback(
+        ClientsideFunction(namespace='cgap', function_name='loadingStyle'),
+        Output('loading', 'style'),
+        Input('loading', 'loading_state')
+    )
+
+    # Callback to handle the file upload(s): start a background ingestion job; poll_ingest_job
+    # fires on the new job id and keeps the poll interval running until the job is done
+    @app.callback(
+        Output('ingest-job', 'data'),
+        [Input('upload-data', 'contents')],
+        [State('upload-data', 'filename')]
+    )
+    @cgap_metrics.timed_callback('import_data')
+    def import_data(contents,filename):
+        if contents:
+            if isinstance(contents, str):
+                contents, filename = [contents], [filename]
+            # Each workbook is parsed in its own worker process; one seen before is served from the on-disk cache.
+            # A wrong file is rejected right away, before it is parsed
+            job_id = cgap_jobs.submit_many([decode_upload(content) for content in contents], filename)
+            return job_id
+
+        return None
+
+    # Callback reporting the ingestion progress and, once ready, the dropdown options
+    @app.callback(
+        [Output('msg_table', 'children'),
+         Output('regulatory-filter', 'options'),
+         Output('ApplicationRate-filter', 'options'),
+         Output('dataset-token', 'data'),
+         Output('ingest-poll', 'disabled')],
+        [Input('ingest-job', 'data'),
+         Input('ingest-poll', 'n_intervals')],
+        [State('session-id', 'data'),
+         State('dataset-token', 'data')]
+    )
+    @cgap_metrics.timed_callback('poll_ingest_job')
+    def poll_ingest_job(job_id, n_intervals, session_id, previous_token):
+        if job_id is None:
+            return(
+                html.Div(['Please upload an Excel file']),  # Return a tuple for the msg_table
+                [],  # Return an empty list for the  options
+                [],
+                None,
+                True
+            )
 
+        job = cgap_jobs.status(job_id)
+        if job['stage'] == 'failed':
+            # Keep the dataset already loaded: only the message changes
+            return (
+                html.Div(['There was an error processing this file: ' + job.get('error', '')], style={'color': 'red'}),
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
+                True
+            )
+        ready = cgap_jobs.result(job_id) if job['stage'] == 'ready' else None
+        if ready is None:
+            return (
+                html.Div([
+                    html.Div('Importing the Excel file: %s ...' % job['stage'] if 'workbooks_ready' not in job else
+                             'Importing the Excel files (%s ready): %s ...' % (job['workbooks_ready'], job['stage']),
+                             style={'color': 'grey'}),
+                    dbc.Progress(value=job['progress'], striped=True, animated=True, className='mt-2'),
+                ]),
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
+                False
+            )
 
-    if contents is not None:
-        print('----file not empty------------')
-         # Process the uploaded file and extract data
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-        
-        # Read the Excel file into a pandas DataFrame, selecting the specified sheet and skipping rows
-        df = pd.read_excel(BytesIO(decoded), sheet_name='MasterGAP', skiprows=6)
-        # Update the column name to replace '\n' with a space
-        print('------ df imported_-_-')
-        rate_columns = [{'label': col, 'value': col} for col in df.columns if col.startswith("Application rate") and col.endswith("(g/ha)")]
-        print(rate_columns)
-        zone_list= [col for col in df.columns if col.lower() in [name.lower() for name in ['Regulatory Zone', 'Residues region']]]
-        rest_columns= [col for col in df.columns if col.lower() in [name.lower() for name in ['Product\n(PLT short)',
-                                                                                              'Crop',
-                                                                                              'applicationn timing BBCH end','application timing BBCH end',
-                                                                                              'Max # of applns.\n(per block)',
-                                                                                             'PHI', 
-                                                                                             'Minimum appl. interval\n(days)',
-                                                                                             'Maximum appl. interval\n(days)']]]
-
-        region_columns= [{'label': col, 'value': col} for col in zone_list]
-        print(region_columns)
-        print('###')
-        print(rest_columns)
-        # Select specific columns from the dataframe
-        cgap_df = df[rest_columns+zone_list+[col for col in df.columns if col.startswith("Application rate") and col.endswith("(g/ha)")]]
-        cgap_df.columns = cgap_df.columns.str.replace('\n', '')
-        # Rename columns based on conditions
-        
-        # Create a new list for the updated column names
-        new_columns = []
-
-        for col in cgap_df.columns:
-            if 'Product' in col and 'PLT' in col:
-                new_columns.append('Product(PLT short)')
-            elif 'Crop' in col:
-                new_columns.append('Crop')
-            elif 'BBCH' in col and 'end' in col:
-                new_columns.append('Application timing BBCH end')
-            else:
-                new_columns.append(col)  # Keep the original name if no conditions are met
-
-        # Assign the new column names to the DataFrame
-        cgap_df.columns = new_columns
-
-
-
-        # Remove rows containing specific crops
-        cgap_df['Crop'] = cgap_df['Crop'].fillna('') 
-        cgap_df = cgap_df[~cgap_df['Crop'].str.contains('rye|triticale|spelt|oat', case=False)]
-
-        # Define a function to simplify crop names
-        def simplify_crops(crop):
-            crop_list = ['Barley', 'Wheat','Cabbage','Onion','Rape']  # Uppercase sensitive
-            for item in crop_list:
-                if item in crop:
-                    return item
-            return crop
-
-        # Apply the simplify_crops function to the 'Crop' column
-        cgap_df['Crop'] = cgap_df['Crop'].apply(simplify_crops)
-        print(cgap_df['Crop'].unique())
-        
-        
-        
-        
-        print('----- function 1 over-------')
+        dataset_key, cgap_df = ready
+        # The browser names the previous dataset, so any worker can load it from the shared cache
+        previous_df = get_dataset(session_id, previous_token)
+        session_store.put(session_id, 'cgap_df', cgap_df)
+        session_store.put(session_id, 'dataset_token', dataset_key)
+        report = None
+        if cgap_versions.INCREMENTAL and previous_df is not None and previous_token != dataset_key:
+            # A revised version of the previous upload: only the groups with changed rows are ranked again
+            report = cgap_aggregate.carry_over(previous_token, previous_df, dataset_key, cgap_df)
+        cgap_aggregate.warm_in_background(dataset_key, cgap_df)
+        cgap_metrics.annotate(rows=len(cgap_df))
+        rate_columns = [{'label': col, 'value': col} for col in rate_columns_of(cgap_df)]
+        region_columns = [{'label': col, 'value': col} for col in region_columns_of(cgap_df)]
 
         # Return the msg-table with the HTML message and the dropdown options
         return (
-            html.Div(['Excel file imported. Select the cGap columns you wish to use for the calculations'],style={'color': 'grey'} ),
-        
+            html.Div([html.Div(['Excel file imported. Select the cGap columns you wish to use for the calculations'],style={'color': 'grey'} ),
+                      change_report_view(report)]),
             region_columns,
-            rate_columns
-
-        )
-
-    else:
-        return(
-            html.Div(['Please upload an Excel file and wait for 5 seconds']),  # Return a tuple for the msg_table
-            [],  # Return an empty list for the  options
-            []
-        )
-
-
-
-@app.callback(
-    Output('crop-filter', 'options'),
-     Output('product-filter', 'options'),
-     Output('region-filter', 'options'),
-    [Input('regulatory-filter', 'value')],
-     [State('upload-data', 'contents'),
-     State('upload-data', 'filename')]
-)
-def update_filter_dropdown(region_columns,contents, filename):
-    
-    global cgap_df
-
-    if contents is not None and region_columns is not None:
-        print('---- updating filter dropdown ---- ')
-        print('region_columns is :  ',region_columns)
-
-        print(cgap_df.columns)
-        print(cgap_df['Product(PLT short)'].unique())
-    
-
-        # Define the options for the dropdowns with the "All" option
-        crop_options = [{'label': 'All', 'value': 'All'}] + [{'label': crop, 'value': crop} for crop in cgap_df['Crop'].unique()]
-        product_options = [{'label': 'All', 'value': 'All'}] + [{'label': product, 'value': product} for product in cgap_df['Product(PLT short)'].dropna().unique()]
-        region_options = [{'label': 'All', 'value': 'All'}] + [{'label': region, 'value': region} for region in cgap_df[region_columns].unique()]
-        print(region_options)
-        return (
-                crop_options,
-                product_options,
-                region_options,
+            rate_columns,
+            dataset_key,
+            True
         )
-    else:
-        return(
-            [],
-            [],  # Return an empty list for the  options
-            []
-        )
-
-
-
-
-@app.callback(
-    Output('filtered-table', 'children'),
-    [Input('regulatory-filter', 'value'),
-     Input('ApplicationRate-filter', 'value'),
-     Input('product-filter', 'value'),
-     Input('crop-filter', 'value'),
-     Input('region-filter', 'value')],
-    [State('upload-data', 'contents'),
-     State('upload-data', 'filename')]
-)
-
-def display_data(region_columns,rate_columns,product_options, crop_options, region_options, contents, filename):
-    global critical_values
-    global cgap_df 
-    print('----- function display data triggered-------')
-
-    if contents is not None:
-
-
-       
-           
-        if rate_columns is not None and region_columns is not None:
-            critical_values = cgap_df.groupby([region_columns,'Product(PLT short)','Crop','Max # of applns.(per block)']).agg({rate_columns: 'max',
-                                                                                        'Application timing BBCH end':'max',
-                                                                                        'PHI':'min',
-                                                                                         'Minimum appl. interval(days)':'min'}).reset_index()
-
-            print('----- columns selected -------')
-
-            # Define the options for the dropdowns with the "All" option
-            
-            # Process the uploaded file and extract options for product and application filters
-            print('++++++region_columns++++',region_columns)
-            print('++++++rate_columns++++',rate_columns)
-            # Update the options for the dropdowns
-            print('+++++product_options+++++',product_options)
-            print('+++++crop_options+++++',crop_options)
-            print('+++++region_options+++++',region_options)
-            filtered_values = critical_values
-            # Apply filtering based on product and application filters
-          
-            if product_options is not None:
-                if product_options == ['All'] or product_options == []:
-                    # Include all available crop options in the filtering process
-                    filtered_values = filtered_values[filtered_values['Product(PLT short)'].isin(filtered_values['Product(PLT short)'].unique())]
-                else:
-                    filtered_values = filtered_values[filtered_values['Product(PLT short)'].isin(product_options)]
-            if region_options is not None:
-                if region_options == ['All'] or  region_options == [] :
-                    # Include all available crop options in the filtering process
-                    filtered_values = filtered_values[filtered_values[region_columns].isin(filtered_values[region_columns].unique())]
-                else:
-
-                    filtered_values = filtered_values[filtered_values[region_columns].isin(region_options)]
-            if crop_options is not None:
-                if crop_options == ['All'] or crop_options == []  :
-                    # Include all available crop options in the filtering process
-                    filtered_values = filtered_values[filtered_values['Crop'].isin(filtered_values['Crop'].unique())]
-                else:
-                    filtered_values = filtered_values[filtered_values['Crop'].isin(crop_options)]
-            
-            print(filtered_values.shape)
-            
-
-            # Display the filtered dataframe using dash_table.DataTable
-            return dash_table.DataTable(
-                columns=[{'name': col, 'id': col} for col in filtered_values.columns],
-                data=filtered_values.to_dict('records'),
-                style_table={
-                    'overflowX': 'scroll',
-                    'overflowY': 'scroll',
-                    'maxHeight': '100vh',
-                    'height': '80%',
-                    'minWidth': '100%'
-                },
-                style_cell={
-                    'minWidth': '80px', 'maxWidth': '180px', 'whiteSpace': 'normal',
-                    'fontSize': '10px'
-                },
-                style_header={
-                    'backgroundColor':'#f9f9f9',
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                    'textAlign': 'center',
-                    'maxWidth': '200px',
-                    'fontSize': '12px'
-                },
-                page_action='none',
-                fixed_rows={'headers': True}
-            )
-        
-        return(
-            html.Div(
-        ['Select the right columns for the appropriate calculations to be performed.'],
-        style={'color': 'red'}  # Set the color to red),  # Return a tuple for the msg_table
-            
-        ))
-        
-    
-  
-
-
-
-
-# Callback to generate the download link
-@app.callback(
-    Output('download-link-container', 'children'),
-    Input('download-button', 'n_clicks'),
-    prevent_initial_call=True
-)
-def generate_download_link(n_clicks):
-    global critical_values  # Access the global variable
-    if n_clicks is not None and n_clicks > 0:
-        # Assume 'critical_values' is the DataFrame you want to download
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            critical_values.to_excel(writer, index=False, sheet_name='Sheet1')
-        output.seek(0)
-        
-        # Encode the Excel file to a base64 string
-        excel_string = base64.b64encode(output.getvalue()).decode()
-        excel_href = f"data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{excel_string}"
-        
-        return html.A('Download Filtered Excel', href=excel_href, download="filtered_data.xlsx", target='_blank', style={'font-weight': 'bold', 'color': 'red'})
-    return no_update
-
 
+    # One server round trip per zone / rate column selection: the filter options, the critical
+    # values and, for tables too large for the browser, the page matching the current table state
+    @app.callback(
+        [Output('critical-store', 'data'),
+         Output('filtered-table', 'children'),
+         Output('crop-filter', 'options'),
+         Output('product-filter', 'options'),
+         Output('region-filter', 'options')],
+        [Input('regulatory-filter', 'value'),
+         Input('ApplicationRate-filter', 'value'),
+         Input('dataset-token', 'data')],
+        [State('product-filter', 'value'),
+         State('crop-filter', 'value'),
+         State('region-filter', 'value'),
+         State('critical-table', 'page_current'),
+         State('critical-table', 'page_size'),
+         State('critical-table', 'sort_by'),
+         State('critical-table', 'filter_query'),
+         State('session-id', 'data')]
+    )
+    @cgap_metrics.timed_callback('load_critical_table')
+    def load_critical_table(region_columns, rate_columns, dataset_token, product, crop, region,
+                            page_current, page_size, sort_by, filter_query, session_id):
+        cgap_df = get_dataset(session_id, dataset_token)
+        if cgap_df is None:
+            return None, None, [], [], []
+        if [t['prop_id'] for t in dash.callback_context.triggered] == ['ApplicationRate-filter.value']:
+            # The options only depend on the dataset and the zone column
+            options = (dash.no_update,) * 3
+        else:
+            options = filter_options(cgap_df, region_columns)
+        if rate_columns is None or region_columns is None:
+            return (None, html.Div(
+                ['Select the right columns for the appropriate calculations to be performed.'],
+                style={'color': 'red'}
+            )) + options
+
+        critical_values = cgap_aggregate.critical_values(dataset_token, cgap_df, region_columns, rate_columns)
+        key = '|'.join([dataset_token, region_columns, rate_columns])
+        store = {'key': key, 'zone_column': region_columns, 'rate_column': rate_columns}
+        if len(critical_values) > CLIENTSIDE_MAX_ROWS:
+            # Filtered and paged on the server; the first page comes with the store, so forwardQuery
+            # only asks for the pages of later table changes
+            query = dict(key=key, zone_column=region_columns, rate_column=rate_columns,
+                         product=product, crop=crop, region=region, page_current=page_current,
+                         page_size=page_size, sort_by=sort_by, filter_query=filter_query)
+            return (dict(store, mode='server', page=server_page(dataset_token, cgap_df, query)), None) + options
+        # Small enough to ship once: product / crop / region filters, sorting and paging then run in the browser
+        cgap_metrics.annotate(rows=len(critical_values))
+        with cgap_metrics.span('store serialization'):
+            table = encode_frame(critical_values)
+        return (dict(store, mode='client', table=table), None) + options
+
+    # Server mode: the table state is forwarded by a clientside callback only for tables too large for the browser
+    app.clientside_callback(
+        ClientsideFunction(namespace='cgap', function_name='forwardQuery'),
+        Output('table-query', 'data'),
+        [Input('product-filter', 'value'),
+         Input('crop-filter', 'value'),
+         Input('region-filter', 'value'),
+         Input('critical-table', 'page_current'),
+         Input('critical-table', 'page_size'),
+         Input('critical-table', 'sort_by'),
+         Input('critical-table', 'filter_query'),
+         Input('critical-store', 'data')]
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='cgap', function_name='renderTable'),
+        [Output('critical-table', 'data'),
+         Output('critical-table', 'columns'),
+         Output('critical-table', 'page_count')],
+        [Input('product-filter', 'value'),
+         Input('crop-filter', 'value'),
+         Input('region-filter', 'value'),
+         Input('critical-table', 'page_current'),
+         Input('critical-table', 'page_size'),
+         Input('critical-table', 'sort_by'),
+         Input('critical-table', 'filter_query'),
+         Input('critical-store', 'data'),
+         Input('server-page', 'data')]
+    )
+
+    @app.callback(
+        Output('server-page', 'data'),
+        [Input('table-query', 'data')],
+        [State('dataset-token', 'data'),
+         State('session-id', 'data')]
+    )
+    @cgap_metrics.timed_callback('display_data')
+    def display_data(query, dataset_token, session_id):
+        cgap_df = get_dataset(session_id, dataset_token)
+        if query is None or cgap_df is None:
+            raise PreventUpdate
+        return server_page(dataset_token, cgap_df, query)
+
+    # Callback exporting the currently filtered table through dcc.Download
+    @app.callback(
+        Output('download-dataframe-csv', 'data'),
+        Input('download-button', 'n_clicks'),
+        [State('regulatory-filter', 'value'),
+         State('ApplicationRate-filter', 'value'),
+         State('product-filter', 'value'),
+         State('crop-filter', 'value'),
+         State('region-filter', 'value'),
+         State('critical-table', 'filter_query'),
+         State('critical-table', 'sort_by'),
+         State('export-format', 'value'),
+         State('dataset-token', 'data'),
+         State('session-id', 'data')],
+        prevent_initial_call=True
+    )
+    @cgap_metrics.timed_callback('generate_download_link')
+    def generate_download_link(n_clicks, region_columns, rate_columns, product_options, crop_options, region_options,
+                               filter_query, sort_by, export_format, dataset_token, session_id):
+        if not n_clicks or region_columns is None or rate_columns is None:
+            raise PreventUpdate
+        cgap_df = get_dataset(session_id, dataset_token)
+        if cgap_df is None:
+            raise PreventUpdate
+        export_format = export_format if export_format in EXPORT_FORMATS else 'xlsx'
+
+        def build():
+            return write_export(filtered_critical_values(dataset_token, cgap_df, region_columns, rate_columns,
+                                                       product_options, crop_options, region_options,
+                                                       filter_query, sort_by), export_format)
+
+        # Same dataset and same selections: serve the file produced for the previous click
+        key = (dataset_token, region_columns, rate_columns, selection_key(product_options), selection_key(crop_options),
+               selection_key(region_options), filter_query or '', repr(sort_by or []), export_format)
+        content = cached_artifact(key, build)
+        return dcc.send_bytes(content, 'filtered_data.' + EXPORT_FORMATS[export_format][1])
+
+
+def preload_libraries():
+    """Import the workbook parser and the export libraries now rather than on first use."""
+    import openpyxl
+    import xlsxwriter
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        pass
+
+
+def create_app():
+    """Build the Dash app. Every WSGI worker process calls this once (see wsgi.py).
+
+    Parsed datasets, ingestion jobs and their status live in the on-disk cache shared by
+    the workers, so a request can be served by any of them.
+    """
+    if not FAST_START:
+        preload_libraries()
+    app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+    app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+    # Callback and pipeline stage latencies, rows and payload sizes on /metrics
+    cgap_metrics.install(app)
+    app.layout = functools.partial(serve_layout, app.get_asset_url('Logo.png'))
+    register_callbacks(app)
+    return app
 
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    create_app().run_server(debug=os.environ.get('CGAP_DEBUG', '1') != '0')
@@ -0,0 +1,199 @@
+# Callback graph and per-action cost of the dashboard, driven through the Flask test client.
+# A small renderer walks /_dash-dependencies the way dash-renderer does: a changed property fires
+# the callbacks it is an input of, server callbacks are posted to /_dash-update-component and
+# clientside ones are run in node from assets/cgap_table.js. The server callbacks of each user
+# action are counted with cgap_callback_requests_total from /metrics.
+import base64
+import json
+import os
+import shutil
+import subprocess
+import warnings
+
+import pytest
+
+import cgap_cache
+import cgap_jobs
+import filtering_ooption_cgaps
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKBOOK = os.path.join(HERE, os.pardir, 'Copy of MasterGApessai.xlsx')
+CLIENTSIDE_SCRIPT = os.path.join(HERE, 'assets', 'cgap_table.js')
+NO_UPDATE = {'__cgap_no_update__': True}
+
+_NODE_RUNNER = """
+const noUpdate = %s;
+global.window = {dash_clientside: {no_update: noUpdate}};
+require(process.argv[1]);
+const call = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const result = window.dash_clientside[call.namespace][call.function_name](...call.args);
+process.stdout.write(JSON.stringify(result === undefined ? null : result));
+""" % json.dumps(NO_UPDATE)
+
+needs_node = pytest.mark.skipif(shutil.which('node') is None, reason='the clientside callbacks need node')
+
+
+def _split_output(output):
+    """['id.property', ...] of a /_dash-dependencies output key."""
+    if output.startswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+def _prop(spec):
+    return '%s.%s' % (spec['id'], spec['property'])
+
+
+class Renderer:
+    """Just enough of dash-renderer to replay user actions against the Flask test client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.dependencies = client.get('/_dash-dependencies').get_json()
+        self.props = {}
+        self._collect(client.get('/_dash-layout').get_json())
+
+    def _collect(self, component):
+        if isinstance(component, list):
+            for child in component:
+                self._collect(child)
+        elif isinstance(component, dict) and 'props' in component:
+            props = component['props']
+            if 'id' in props:
+                for name, value in props.items():
+                    self.props['%s.%s' % (props['id'], name)] = value
+            self._collect(props.get('children'))
+
+    def server_requests(self):
+        """Total of cgap_callback_requests_total over all triggers."""
+        lines = self.client.get('/metrics').get_data(as_text=True).splitlines()
+        return sum(float(line.rsplit(' ', 1)[1]) for line in lines
+                   if line.startswith('cgap_callback_requests_total{'))
+
+    def _run_server(self, dependency, outputs, changed):
+        inputs = [dict(spec, value=self.props.get(_prop(spec))) for spec in dependency['inputs']]
+        state = [dict(spec, value=self.props.get(_prop(spec))) for spec in dependency['state']]
+        specs = [dict(zip(('id', 'property'), output.split('.', 1))) for output in outputs]
+        response = self.client.post('/_dash-update-component', json={
+            'output': dependency['output'],
+            'outputs': specs if dependency['output'].startswith('..') else specs[0],
+            'inputs': inputs,
+            'state': state,
+            'changedPropIds': changed,
+        })
+        if response.status_code == 204:
+            return {}
+        assert response.status_code == 200, response.get_data(as_text=True)[:500]
+        body = response.get_json()['response']
+        if 'props' in body and not body.get('multi'):
+            # Single-output response of dash 1.x
+            body = {specs[0]['id']: body['props']}
+        values = {'%s.%s' % (component_id, name): value
+                  for component_id, props in body.items() for name, value in props.items()}
+        # dash-renderer refuses responses for properties the callback does not output
+        assert set(values) <= set(outputs), (dependency['output'], sorted(values))
+        return values
+
+    def _run_clientside(self, dependency, outputs):
+        function = dependency['clientside_function']
+        call = dict(function, args=[self.props.get(_prop(spec)) for spec in dependency['inputs'] + dependency['state']])
+        result = subprocess.run(['node', '-e', _NODE_RUNNER, CLIENTSIDE_SCRIPT], input=json.dumps(call),
+                                capture_output=True, text=True, check=True)
+        result = json.loads(result.stdout)
+        result = result if len(outputs) > 1 else [result]
+        if result == [NO_UPDATE]:
+            return {}
+        return {output: value for output, value in zip(outputs, result) if value != NO_UPDATE}
+
+    def set_props(self, **changes):
+        """Apply a user change ({'component__property': value}) and run the callbacks it fires."""
+        pending = [dict(('%s.%s' % tuple(name.split('__', 1)), value) for name, value in changes.items())]
+        while pending:
+            changed = pending.pop(0)
+            self.props.update(changed)
+            for dependency in self.dependencies:
+                triggers = [_prop(spec) for spec in dependency['inputs'] if _prop(spec) in changed]
+                if not triggers:
+                    continue
+                outputs = _split_output(dependency['output'])
+                if dependency['clientside_function']:
+                    values = self._run_clientside(dependency, outputs)
+                else:
+                    values = self._run_server(dependency, outputs, triggers)
+                if values:
+                    pending.append(values)
+
+    def action(self, **changes):
+        """Server callbacks a user change cost."""
+        before = self.server_requests()
+        self.set_props(**changes)
+        return self.server_requests() - before
+
+
+@pytest.fixture
+def renderer(tmp_path, monkeypatch):
+    monkeypatch.setattr(cgap_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(cgap_jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(cgap_jobs, 'BACKGROUND', False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        app = filtering_ooption_cgaps.create_app()
+    return Renderer(app.server.test_client())
+
+
+def _upload(renderer):
+    with open(WORKBOOK, 'rb') as f:
+        contents = 'data:application/vnd.ms-excel;base64,' + base64.b64encode(f.read()).decode()
+    renderer.set_props(**{'upload-data__filename': ['MasterGApessai.xlsx'], 'upload-data__contents': [contents]})
+    assert renderer.props['dataset-token.data']
+    return renderer.props['regulatory-filter.options'], renderer.props['ApplicationRate-filter.options']
+
+
+def _select_columns(renderer):
+    zones, rates = _upload(renderer)
+    assert renderer.action(**{'regulatory-filter__value': zones[0]['value']}) == 1
+    assert renderer.action(**{'ApplicationRate-filter__value': rates[0]['value']}) == 1
+    assert renderer.props['critical-table.data']
+
+
+def test_no_output_has_two_callbacks(renderer):
+    outputs = [output for dependency in renderer.dependencies for output in _split_output(dependency['output'])]
+    assert sorted(output for output in set(outputs) if outputs.count(output) > 1) == []
+
+
+@needs_node
+def test_clientside_mode_actions(renderer):
+    _select_columns(renderer)
+    assert renderer.props['critical-store.data']['mode'] == 'client'
+
+    products = renderer.props['product-filter.options']
+    assert renderer.action(**{'product-filter__value': [products[0]['value']]}) == 0
+    assert renderer.action(**{'critical-table__filter_query': '{PHI} ge 0'}) == 0
+    assert renderer.action(**{'critical-table__page_current': 1}) == 0
+    assert renderer.action(**{'product-filter__value': []}) == 0
+
+
+@needs_node
+def test_server_mode_actions(renderer, monkeypatch):
+    monkeypatch.setattr(filtering_ooption_cgaps, 'CLIENTSIDE_MAX_ROWS', 0)
+    _select_columns(renderer)
+    assert renderer.props['critical-store.data']['mode'] == 'server'
+
+    products = renderer.props['product-filter.options']
+    assert renderer.action(**{'product-filter__value': [products[0]['value']]}) == 1
+    assert renderer.action(**{'critical-table__page_current': 1}) == 1
+    assert renderer.action(**{'product-filter__value': []}) == 1
+    assert renderer.props['server-page.data']['query']['page_current'] == 1
+
+
+@needs_node
+def test_failed_upload_keeps_dataset(renderer):
+    _select_columns(renderer)
+    token, store = renderer.props['dataset-token.data'], renderer.props['critical-store.data']
+
+    renderer.set_props(**{'upload-data__filename': ['notes.txt'],
+                          'upload-data__contents': ['data:text/plain;base64,' + base64.b64encode(b'notes').decode()]})
+    assert 'error' in json.dumps(renderer.props['msg_table.children'])
+    assert renderer.props['dataset-token.data'] == token
+    assert renderer.props['critical-store.data'] == store
@@ -0,0 +1,10 @@
+# WSGI entry point for running the dashboard with several worker processes, e.g.
+#
+#   gunicorn --chdir Dashboard wsgi:server --workers 4 --timeout 300
+#
+# Uploaded datasets and ingestion jobs are kept in the on-disk cache (CGAP_CACHE_DIR), which
+# every worker reads, so the polling and filtering requests of a browser may hit any worker.
+from filtering_ooption_cgaps import create_app
+
+app = create_app()
+server = app.server